@@ -35,7 +35,12 @@ def get_model(model_name,
               out_channels,
               domain_rows,
               domain_cols,
-              exp):
+              exp,
+              device=None):
+    r"""
+    Build the model on device. None uses the GPU. Distributed models are
+    placed on the GPU of the local rank.
+    """
     assert model_name in _MODEL_LIST, f'Model name {model_name} invalid'
     if model_name == _UNET_ARENA:
         model = Unet(in_channels=in_channels,
@@ -104,5 +109,5 @@ def get_model(model_name,
         model = DDP(model, device_ids=[local_rank], output_device=local_rank,
                     find_unused_parameters=False)
     else:
-        model = model.cuda().float()
+        model = model.to(device or 'cuda').float()
     return model
@@ -0,0 +1,60 @@
+import torch
+
+class BatchHFlip:
+    r"""
+    Random horizontal flip of a collated batch. Each sample of the batch
+    is flipped with probability p, with one masked torch.where per tensor.
+    All tensors of a sample get the same flip, so inputs and labels stay
+    consistent. A mirrored flow has a mirrored x-velocity, so the velx
+    channels are negated. The coordinates describe the grid, which does
+    not move, so they are never flipped.
+
+    Args:
+        outputs (tuple): What each tensor of a batch holds, see the outputs
+            attribute of the datasets. 'coords' is left alone, 'vel' is
+            interleaved as [velx_0, vely_0, velx_1, ...] along dim -3,
+            anything else is a scalar field.
+        p (float): Probability of flipping a sample.
+        seed (int): Seed of the flips. None uses torch's default generator.
+            In a DataLoader worker, the generator is seeded with
+            seed + the worker's seed, so workers do not repeat each
+            other's flips. To make these reproducible, pass the DataLoader
+            a seeded generator.
+    """
+    def __init__(self, outputs, p=0.5, seed=None):
+        assert 0 <= p <= 1, 'BatchHFlip: p should be a probability'
+        self.outputs = tuple(outputs)
+        self.p = p
+        self.seed = seed
+        self._generator = None
+        self._worker_id = None
+
+    def _get_generator(self):
+        if self.seed is None:
+            return None
+        info = torch.utils.data.get_worker_info()
+        worker_id = info.id if info is not None else None
+        if self._generator is None or worker_id != self._worker_id:
+            self._generator = torch.Generator()
+            self._generator.manual_seed(self.seed if info is None else (self.seed + info.seed) % 2 ** 63)
+            self._worker_id = worker_id
+        return self._generator
+
+    def __call__(self, batch):
+        assert len(batch) == len(self.outputs), 'BatchHFlip: batch does not match outputs'
+        batch_size = len(batch[0])
+        flip = torch.rand(batch_size, generator=self._get_generator()) < self.p
+        if not flip.any():
+            return list(batch)
+        flipped = []
+        for kind, tensor in zip(self.outputs, batch):
+            if kind != 'coords':
+                mask = flip.to(tensor.device).view(-1, *[1] * (tensor.dim() - 1))
+                mirrored = tensor.flip(-1)
+                if kind == 'vel':
+                    sign = torch.ones(tensor.shape[-3], dtype=tensor.dtype, device=tensor.device)
+                    sign[0::2] = -1
+                    mirrored.mul_(sign.view(-1, 1, 1))
+                tensor = torch.where(mask, mirrored, tensor)
+            flipped.append(tensor)
+        return flipped
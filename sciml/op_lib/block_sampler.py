@@ -0,0 +1,142 @@
+import math
+import torch
+from torch.utils.data import ConcatDataset, Sampler
+from . import dist_utils
+
+class BlockShuffleSampler(Sampler):
+    r"""
+    Shuffles a (concatenated) simulation dataset at the block level, so reads
+    are mostly sequential within a file. Each epoch:
+      1. every file is split into contiguous blocks of block_size timesteps,
+      2. the blocks are shuffled and each rank takes a contiguous run of
+         them, so it reads contiguous frames,
+      3. each rank reads files_in_flight files at a time, picking a random
+         one of them for each block,
+      4. the indices pass through a shuffle buffer of buffer_size.
+    The order only depends on seed and the epoch, see set_epoch.
+
+    Args:
+        dataset (Dataset): A dataset, or a ConcatDataset with one dataset per file.
+        block_size (int): Number of consecutive timesteps in a block.
+        files_in_flight (int): Number of files interleaved at once.
+        buffer_size (int): Size of the shuffle buffer. 1 keeps the block order.
+        shuffle (bool): If False, blocks are read in order and there is no buffer.
+        seed (int): Seed of the shuffles. Must be the same on every rank.
+        num_replicas (int): Number of ranks. None uses dist_utils.world_size()
+        rank (int): Rank of this process. None uses dist_utils.rank()
+        drop_last (bool): Drop the tail so ranks get the same number of
+            samples. Otherwise, ranks are padded by repeating samples.
+    """
+    def __init__(self,
+                 dataset,
+                 block_size=32,
+                 files_in_flight=2,
+                 buffer_size=256,
+                 shuffle=True,
+                 seed=0,
+                 num_replicas=None,
+                 rank=None,
+                 drop_last=False):
+        assert block_size > 0 and files_in_flight > 0 and buffer_size > 0
+        self.block_size = block_size
+        self.files_in_flight = files_in_flight
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas if num_replicas is not None else dist_utils.world_size()
+        self.rank = rank if rank is not None else dist_utils.rank()
+        assert 0 <= self.rank < self.num_replicas, 'BlockShuffleSampler: invalid rank'
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        # [start, end) of each file in the dataset's indices
+        sizes = [len(d) for d in dataset.datasets] if isinstance(dataset, ConcatDataset) else [len(dataset)]
+        self.file_ranges = []
+        start = 0
+        for size in sizes:
+            self.file_ranges.append((start, start + size))
+            start += size
+
+        total = sum(sizes)
+        if self.drop_last:
+            self.num_samples = total // self.num_replicas
+        else:
+            self.num_samples = math.ceil(total / self.num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples
+
+    def _blocks(self):
+        r"""
+        (file, indices) of every block
+        """
+        return [(f, list(range(b, min(b + self.block_size, end))))
+                for f, (start, end) in enumerate(self.file_ranges)
+                for b in range(start, end, self.block_size)]
+
+    def _interleave(self, blocks, g):
+        r"""
+        Order the blocks of this rank, reading files_in_flight files at once.
+        """
+        by_file = {}
+        for block in blocks:
+            by_file.setdefault(block[0], []).append(block)
+        pending = [by_file[f] for f in sorted(by_file)]
+        pending = [pending[i] for i in torch.randperm(len(pending), generator=g).tolist()]
+        active, order = [], []
+        while pending or active:
+            while pending and len(active) < self.files_in_flight:
+                active.append(pending.pop(0))
+            i = torch.randint(len(active), (1,), generator=g).item()
+            order.append(active[i].pop(0))
+            if not active[i]:
+                active.pop(i)
+        return order
+
+    def _buffer_shuffle(self, indices, g):
+        buffer = []
+        for idx in indices:
+            buffer.append(idx)
+            if len(buffer) == self.buffer_size:
+                i = torch.randint(len(buffer), (1,), generator=g).item()
+                buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                yield buffer.pop()
+        while buffer:
+            i = torch.randint(len(buffer), (1,), generator=g).item()
+            buffer[i], buffer[-1] = buffer[-1], buffer[i]
+            yield buffer.pop()
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        blocks = self._blocks()
+        if self.shuffle:
+            blocks = [blocks[i] for i in torch.randperm(len(blocks), generator=g).tolist()]
+
+        # each rank gets a contiguous run of num_samples indices in block order,
+        # so only the blocks on the boundaries between ranks are split.
+        # every rank computes the same order, since g is seeded the same.
+        total = sum(len(indices) for _, indices in blocks)
+        padded = self.num_samples * self.num_replicas
+        if padded > total:
+            # pad by repeating blocks, as DistributedSampler repeats samples
+            blocks = blocks * math.ceil(padded / total)
+        begin, end = self.rank * self.num_samples, (self.rank + 1) * self.num_samples
+        rank_blocks, offset = [], 0
+        for f, indices in blocks:
+            lo, hi = max(begin - offset, 0), min(end - offset, len(indices))
+            if lo < hi:
+                rank_blocks.append((f, indices[lo:hi]))
+            offset += len(indices)
+            if offset >= end:
+                break
+        if self.shuffle:
+            rank_blocks = self._interleave(rank_blocks, g)
+        indices = [i for _, block in rank_blocks for i in block]
+
+        if self.shuffle and self.buffer_size > 1:
+            return iter(list(self._buffer_shuffle(indices, g)))
+        return iter(indices)
@@ -0,0 +1,72 @@
+import math
+import torch
+from torch.utils.data import ConcatDataset, RandomSampler, SequentialSampler
+from .hdf5_dataset import expand_vapor_mask
+
+class DeviceLoader:
+    r"""
+    Replaces the train DataLoader when the in-memory datasets fit on the
+    training device. Call dataset.to(device) first: each batch is then
+    gathered with one advanced index per field and file, so there are no
+    workers, no collation and no host to device copies.
+
+    Args:
+        dataset (Dataset): An in-memory dataset (hdf5_dataset.HDF5Dataset),
+            or a ConcatDataset of them, already moved to the device.
+        batch_size (int): Number of samples in a batch.
+        shuffle (bool): Shuffle the samples, when sampler is None.
+        sampler (Sampler): Order of the samples, e.g. a DistributedSampler.
+        drop_last (bool): Drop the last incomplete batch.
+        augment (callable): Applied to each gathered batch, e.g. augment.BatchHFlip
+    """
+    def __init__(self,
+                 dataset,
+                 batch_size,
+                 shuffle=False,
+                 sampler=None,
+                 drop_last=False,
+                 augment=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.augment = augment
+        if sampler is None:
+            sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        self.sampler = sampler
+        self.datasets = dataset.datasets if isinstance(dataset, ConcatDataset) else [dataset]
+        self.cumulative_sizes = torch.tensor([0] + list(ConcatDataset.cumsum(self.datasets)))
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return math.ceil(len(self.sampler) / self.batch_size)
+
+    def __iter__(self):
+        indices = torch.tensor(list(iter(self.sampler)), dtype=torch.long)
+        for batch in indices.split(self.batch_size):
+            if self.drop_last and len(batch) < self.batch_size:
+                return
+            yield self._gather(batch)
+
+    def _gather(self, indices):
+        r"""
+        Gather the samples at indices of the (concatenated) dataset.
+        Indices are grouped by file, so each file is indexed once.
+        """
+        file_idx = torch.searchsorted(self.cumulative_sizes, indices, right=True) - 1
+        order, parts = [], []
+        for f in file_idx.unique().tolist():
+            in_file = (file_idx == f).nonzero().squeeze(1)
+            dataset = self.datasets[f]
+            timesteps = (indices[in_file] - self.cumulative_sizes[f]).to(dataset._coords.device)
+            parts.append(dataset[timesteps])
+            order.append(in_file)
+        # samples are returned in the order of the sampler
+        inverse = torch.cat(order).argsort()
+        batch = []
+        for tensors in zip(*parts):
+            tensor = torch.cat(tensors, dim=0)
+            batch.append(tensor[inverse.to(tensor.device)])
+        if self.augment is not None:
+            batch = self.augment(batch)
+        return [expand_vapor_mask(tensor) for tensor in batch]
@@ -3,38 +3,110 @@ import numpy as np
 import torch
 from torch.utils.data import ConcatDataset, Dataset
 import h5py
-import random
 from torchvision.transforms import Resize
-import torchvision.transforms.functional as TF
 from pathlib import Path
 #for nucleation 
-from .nucleation import heater_init, dfun_init
+from .nucleation import cached_nucleation_layer
+from .stats import field_stats
+from .downsample import as_factor, downsample_domain, pool_domain, downsampled_size
+
+def worker_init_fn(worker_id):
+    r"""
+    Give each DataLoader worker its own HDF5 handles.
+    """
+    dataset = torch.utils.data.get_worker_info().dataset
+    datasets = dataset.datasets if isinstance(dataset, ConcatDataset) else [dataset]
+    for d in datasets:
+        if isinstance(d, DiskHDF5Dataset):
+            d.open()
 
 class DiskHDF5Dataset(Dataset):
+    # fields read from the hdf5 file. Subclasses only read what they use.
+    fields = ('temp', 'vel', 'dfun')
+
     def __init__(self,
                  filename,
                  steady_time,
                  transform=False,
                  time_window=1,
                  future_window=1,
-                 push_forward_steps=1):
+                 push_forward_steps=1,
+                 rdcc_nbytes=None,
+                 rdcc_nslots=None,
+                 stats_cache_dir=None,
+                 downsample_factor=1,
+                 pool='stride'):
         super().__init__()
         assert time_window > 0, 'HDF5Dataset.__init__():time window should be positive'
+        self.filename = filename
         self.steady_time = steady_time
+        # samples are flipped after collation, see augment.BatchHFlip
+        assert not transform, 'transform is applied to batches, see augment.BatchHFlip'
         self.transform = transform
         self.time_window = time_window
         self.future_window = future_window
         self.push_forward_steps = push_forward_steps
-        
-        self._data = h5py.File(filename, 'r')
+
+        # size of the HDF5 chunk cache. None uses the h5py default (1MB)
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
+        # sidecar cache of the field statistics. None keeps it next to the file
+        self.stats_cache_dir = stats_cache_dir
+        # 'stride' reads only the needed rows and columns of each window,
+        # 'avg' averages patches of the full window.
+        self.downsample_factor = as_factor(downsample_factor)
+        self.pool = pool
+
+        # the file is opened lazily in each process that reads from it,
+        # so DataLoader workers never share a handle with the parent.
+        self._file = None
+        self._pid = None
+        with h5py.File(filename, 'r') as f:
+            num_frames, rows, cols = f['temperature'].shape
+            self._shape = (num_frames, *downsampled_size(self.downsample_factor, rows, cols, pool))
+            # the grid is static, so the normalized coordinates are computed once
+            x = torch.from_numpy(f['x'][steady_time])
+            y = torch.from_numpy(f['y'][steady_time])
+        self._grid = (x, y)
+        coords = torch.stack([x / x.max(), y / y.max()], dim=0).to(torch.float32)
+        self._coords = self._downsample(coords)
 
         # these values are used to redimensionalize and then normalize data 
         self.wall_temp = self._get_wall_temp(filename)
         self.temp_scale = None
         self.vel_scale = None
 
+    @property
+    def _data(self):
+        if self._file is None or self._pid != os.getpid():
+            self.open()
+        return self._file
+
+    def open(self):
+        r"""
+        Open a handle to the HDF5 file for the current process.
+        """
+        self._file = h5py.File(self.filename,
+                               'r',
+                               rdcc_nbytes=self.rdcc_nbytes,
+                               rdcc_nslots=self.rdcc_nslots)
+        self._pid = os.getpid()
+
+    def close(self):
+        if self._file is not None and self._pid == os.getpid():
+            self._file.close()
+        self._file = None
+        self._pid = None
+
+    def __getstate__(self):
+        # h5py handles cannot be pickled (e.g., for spawned workers)
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_pid'] = None
+        return state
+
     def datum_dim(self):
-        return self._data['temperature'][:].shape
+        return self._shape
 
     def __len__(self):
         # len is the number of timesteps. Each prediction
@@ -42,12 +114,34 @@ class DiskHDF5Dataset(Dataset):
         # the first few frames.
         # we may also predict several frames in the future, so we
         # can't include those in length
-        total_size = self._data['temperature'].shape[0] - self.steady_time
+        total_size = self._shape[0] - self.steady_time
         return total_size - self.time_window - (self.future_window * self.push_forward_steps - 1) 
 
     def _index_data(self, key, timestep):
         return self._data[key][self.steady_time + timestep]
 
+    def _index_window(self, key, timestep, length):
+        r"""
+        Read frames {timestep, ..., timestep + length - 1} with a single hyperslab read.
+        Strided downsampling is part of the read. Pooling is left to the caller.
+        """
+        start = self.steady_time + timestep
+        rf, cf = self.downsample_factor if self.pool == 'stride' else (1, 1)
+        return self._data[key][start:start + length, ..., ::rf, ::cf]
+
+    def _downsample(self, field):
+        if self.pool == 'avg':
+            return pool_domain(self.downsample_factor, field)[0]
+        return downsample_domain(self.downsample_factor, field)[0]
+
+    def _pool(self, window):
+        r"""
+        Pool a window returned by _index_window. Strided windows are already downsampled.
+        """
+        if self.pool == 'avg':
+            return pool_domain(self.downsample_factor, window)[0]
+        return window
+
     def _get_data(self, key):
         return self._data[key][self.steady_time:]
 
@@ -67,11 +161,17 @@ class DiskHDF5Dataset(Dataset):
             return 1
         return float(filename[len(TWALL):])
 
+    def stats(self, keys):
+        r"""
+        Cached statistics of the fields in keys, see stats.field_stats
+        """
+        return field_stats(self.filename, keys, self.steady_time, self.stats_cache_dir)
+
     def absmax_temp(self):
-        return np.abs(self._get_data('temperature') * self.wall_temp).max()
+        return self.stats(['temperature'])['temperature']['absmax'] * self.wall_temp
 
     def absmax_vel(self):
-        return max(np.abs(self._get_data('velx')).max(), np.abs(self._get_data('vely')).max())
+        return max(s['absmax'] for s in self.stats(['velx', 'vely']).values())
 
     def normalize_temp_(self, scale):
         self.temp_scale = scale
@@ -84,41 +184,50 @@ class DiskHDF5Dataset(Dataset):
         """
         return self._get_data('y')[0, 0, 0]
 
+    def get_x(self):
+        r"""
+        x of frames time_window onward, normalized by its max and downsampled,
+        as in HDF5Dataset.get_x
+        """
+        num_frames = self._shape[0] - self.steady_time - self.time_window
+        return self._coords[0].expand(num_frames, *self._coords.shape[1:])
+
     def get_dfun(self):
-        return torch.from_numpy(self._get_data('dfun')[self.time_window:])
+        r"""
+        The sign of dfun (float32) of frames time_window onward, downsampled,
+        as in HDF5Dataset.get_dfun
+        """
+        num_frames = self._shape[0] - self.steady_time - self.time_window
+        return self._get_dfun_window(self.time_window, num_frames).to(torch.float32)
 
-    def _get_temp(self, timestep):
+    def _get_temp_window(self, timestep, length):
         assert self.temp_scale is not None, 'Normalize not called?'
-        temp = torch.from_numpy(self._index_data('temperature', timestep))
+        temp = torch.from_numpy(self._pool(self._index_window('temperature', timestep, length)))
         return (2 * (temp * self.wall_temp) / self.temp_scale) - 1
 
-    def _get_vel_stack(self, timestep):
+    def _get_vel_window(self, timestep, length):
+        r"""
+        Velocities for `length` frames, interleaved as [velx_0, vely_0, velx_1, ...]
+        """
         assert self.vel_scale is not None, 'Normalize not called?'
         vel = torch.stack([
-            torch.from_numpy(self._index_data('velx', timestep)),
-            torch.from_numpy(self._index_data('vely', timestep)),
-        ], dim=0)
-        return vel / self.vel_scale
+            torch.from_numpy(self._pool(self._index_window('velx', timestep, length))),
+            torch.from_numpy(self._pool(self._index_window('vely', timestep, length))),
+        ], dim=1)
+        return vel.flatten(0, 1) / self.vel_scale
 
     def _get_coords(self, timestep):
-        x = torch.from_numpy(self._index_data('x', timestep))
-        x /= x.max()
-        y = torch.from_numpy(self._index_data('y', timestep))
-        y /= y.max()
-        coords = torch.stack([
-            x, y
-        ], dim=0)
-        return coords
-
-    def _get_dfun(self, timestep):
-        vapor_mask = torch.from_numpy(self._index_data('dfun', timestep)) > 0
-        return vapor_mask.to(float) - 0.5
-
-    def _transform(self, *args):
-        if self.transform:
-            if random.random() > 0.5:
-                args = tuple([TF.hflip(arg) for arg in args])
-        return args
+        r"""
+        The normalized coordinates [2 x H x W] are static in time.
+        """
+        return self._coords
+
+    def _get_dfun_window(self, timestep, length):
+        r"""
+        Packed vapor mask (the sign of dfun), see hdf5_dataset.expand_vapor_mask
+        """
+        dfun = np.sign(np.nan_to_num(self._index_window('dfun', timestep, length)))
+        return torch.from_numpy(np.sign(self._pool(dfun)).astype(np.int8))
 
     def __getitem__(self, timestep):
         assert False, 'Not Implemented'
@@ -130,19 +239,23 @@ class DiskTempInputDataset(DiskHDF5Dataset):
     past predictions for temperature and using them to make future
     predictions.
     """
-    def __init__(self, filename, steady_time, use_coords, transform=False, time_window=1, future_window=1, push_forward_steps=1):
-        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps)
+    fields = ('temp', 'vel')
+    # what each tensor of a sample holds, see augment.BatchHFlip
+    outputs = ('coords', 'temp', 'vel', 'temp')
+
+    def __init__(self, filename, steady_time, use_coords, transform=False, time_window=1, future_window=1, push_forward_steps=1, **kwargs):
+        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps, **kwargs)
         coords_dim = 2 if use_coords else 0
         self.in_channels = 3 * self.time_window + coords_dim + 2 * self.future_window
         self.out_channels = self.future_window
 
     def __getitem__(self, timestep):
         coords = self._get_coords(timestep)
-        temps = torch.stack([self._get_temp(timestep + k) for k in range(self.time_window)], dim=0)
-        vel = torch.cat([self._get_vel_stack(timestep + k) for k in range(self.time_window + self.future_window)], dim=0) 
-        base_time = timestep + self.time_window 
-        label = torch.stack([self._get_temp(base_time + k) for k in range(self.future_window)], dim=0)
-        return (coords, *self._transform(temps, vel, label))
+        # one read per field covers both the input and label frames
+        temp_window = self._get_temp_window(timestep, self.time_window + self.future_window)
+        temps, label = temp_window[:self.time_window], temp_window[self.time_window:]
+        vel = self._get_vel_window(timestep, self.time_window + self.future_window)
+        return coords, temps, vel, label
         
 class DiskVelInputDataset(DiskHDF5Dataset):
     r""" 
@@ -151,6 +264,10 @@ class DiskVelInputDataset(DiskHDF5Dataset):
     past predictions for velocities and using them to make future
     predictions.
     """
+    fields = ('vel', 'dfun')
+    # what each tensor of a sample holds, see augment.BatchHFlip
+    outputs = ('vel', 'dfun', 'vel')
+
     def __init__(self,
                  filename,
                  steady_time,
@@ -158,19 +275,20 @@ class DiskVelInputDataset(DiskHDF5Dataset):
                  transform=False,
                  time_window=1,
                  future_window=1,
-                 push_forward_steps=1):
-        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps)
+                 push_forward_steps=1,
+                 **kwargs):
+        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps, **kwargs)
         self.in_channels = 3 * self.time_window  #2 for current velocity 1 for current dfun 
         self.out_channels =2 * self.future_window #for two future velocity vx and vy 
 
     def __getitem__(self, timestep):
-        # past velocity
-        vel = torch.cat([self._get_vel_stack(timestep + k) for k in range(self.time_window)], dim=0).unsqueeze(0);
-        base_time = timestep + self.time_window 
-        label = torch.cat([self._get_vel_stack(base_time + k) for k in range(self.future_window)], dim=0).unsqueeze(0);
-        # past and future dfun
-        dfun = torch.stack([self._get_dfun(timestep + k) for k in range(self.time_window)], dim=0).unsqueeze(0);
-        return self._transform(vel, dfun, label)
+        # past velocity and label
+        vel_window = self._get_vel_window(timestep, self.time_window + self.future_window)
+        vel = vel_window[:2 * self.time_window].unsqueeze(0)
+        label = vel_window[2 * self.time_window:].unsqueeze(0)
+        # past dfun
+        dfun = self._get_dfun_window(timestep, self.time_window).unsqueeze(0)
+        return vel, dfun, label
         
 class DiskVelCoordInputDataset(DiskHDF5Dataset):
     r""" 
@@ -179,6 +297,10 @@ class DiskVelCoordInputDataset(DiskHDF5Dataset):
     past predictions for velocities and using them to make future
     predictions.
     """
+    fields = ('vel', 'dfun')
+    # what each tensor of a sample holds, see augment.BatchHFlip
+    outputs = ('coords', 'vel', 'dfun', 'vel')
+
     def __init__(self,
                  filename,
                  steady_time,
@@ -186,21 +308,22 @@ class DiskVelCoordInputDataset(DiskHDF5Dataset):
                  transform=False,
                  time_window=1,
                  future_window=1,
-                 push_forward_steps=1):
-        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps)
+                 push_forward_steps=1,
+                 **kwargs):
+        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps, **kwargs)
         coords_dim = 2 if use_coords else 0
         self.in_channels = coords_dim + 3 * self.time_window #2 for current velocity 1 for current dfun 
         self.out_channels =2 * self.future_window #for two future velocity vx and vy 
 
     def __getitem__(self, timestep):
         coords = self._get_coords(timestep).unsqueeze(0)
-        # past velocity
-        vel = torch.cat([self._get_vel_stack(timestep + k) for k in range(self.time_window)], dim=0).unsqueeze(0)
-        base_time = timestep + self.time_window 
-        label = torch.cat([self._get_vel_stack(base_time + k) for k in range(self.future_window)], dim=0).unsqueeze(0)
-        # past and future dfun
-        dfun = torch.stack([self._get_dfun(timestep + k) for k in range(self.time_window)], dim=0).unsqueeze(0)
-        return self._transform(coords, vel, dfun, label)
+        # past velocity and label
+        vel_window = self._get_vel_window(timestep, self.time_window + self.future_window)
+        vel = vel_window[:2 * self.time_window].unsqueeze(0)
+        label = vel_window[2 * self.time_window:].unsqueeze(0)
+        # past dfun
+        dfun = self._get_dfun_window(timestep, self.time_window).unsqueeze(0)
+        return coords, vel, dfun, label
 
 class DiskVelDfunDataset(DiskHDF5Dataset):
     r""" 
@@ -209,6 +332,10 @@ class DiskVelDfunDataset(DiskHDF5Dataset):
     past predictions for velocities and using them to make future
     predictions.
     """
+    fields = ('vel', 'dfun')
+    # what each tensor of a sample holds, see augment.BatchHFlip
+    outputs = ('vel', 'dfun', 'nucleation', 'vel', 'dfun')
+
     def __init__(self,
                  filename,
                  steady_time,
@@ -216,58 +343,32 @@ class DiskVelDfunDataset(DiskHDF5Dataset):
                  transform=False,
                  time_window=1,
                  future_window=1,
-                 push_forward_steps=1):
-        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps)
+                 push_forward_steps=1,
+                 nucleation_cache_dir=None,
+                 **kwargs):
+        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps, **kwargs)
         self.filename = filename
+        # the nucleation layer only depends on the file and grid, so it is built once
+        # the grid read by __init__, so the parent process never opens the
+        # lazy handle that forked workers would inherit
+        coordx, coordy = self._grid[0].numpy(), self._grid[1].numpy()
+        layer = cached_nucleation_layer(filename, coordx, coordy, cache_dir=nucleation_cache_dir)
+        self._nucleation_layer = self._downsample(layer)
         coords_dim = 2 if use_coords else 0
         self.in_channels = 3 * self.time_window + 1 #2 for current velocity 1 for current dfun 1 for nucleation layer 
         self.out_channels =3 * self.future_window #for two future velocity vx and vy and 1 future dfun 
 
-    #added function to get num sites based on different files 
-    def get_num_sites(self, filename):
-        r"""
-        Extracts the Twall value from the filename and maps it to the corresponding
-        number of nucleation sites.
-        """
-        filename = Path(filename).stem
-        TWALL_PREFIX = 'Twall-'
-        # Define a mapping from Twall value to the number of nucleation sites.
-        twall_to_num_sites_map = {
-            '90': 15, '92': 17, '95': 19, '97': 21, '98': 22,
-            '100': 24, '102': 25, '106': 27, '108': 27, '110': 27
-        }
-        # Extract Twall value and convert it to an integer.
-        twall_value = filename.split(TWALL_PREFIX)[-1]
-        # Return the number of nucleation sites from the map.
-        return twall_to_num_sites_map.get(twall_value, 0) 
-        
     def __getitem__(self, timestep):
-        # past velocity
-        vel = torch.cat([self._get_vel_stack(timestep + k) for k in range(self.time_window)], dim=0).unsqueeze(0)
-        base_time = timestep + self.time_window 
-        vel_label = torch.cat([self._get_vel_stack(base_time + k) for k in range(self.future_window)], dim=0).unsqueeze(0)
-        # past dfun
-        dfun = torch.stack([self._get_dfun(timestep + k) for k in range(self.time_window)], dim=0).unsqueeze(0)
-        dfun_label = torch.stack([self._get_dfun(base_time + k) for k in range(self.future_window)], dim=0).unsqueeze(0)
+        # past velocity and dfun, with their labels
+        vel_window = self._get_vel_window(timestep, self.time_window + self.future_window)
+        vel = vel_window[:2 * self.time_window].unsqueeze(0)
+        vel_label = vel_window[2 * self.time_window:].unsqueeze(0)
+        dfun_window = self._get_dfun_window(timestep, self.time_window + self.future_window)
+        dfun = dfun_window[:self.time_window].unsqueeze(0)
+        dfun_label = dfun_window[self.time_window:].unsqueeze(0)
         
-        #for nucleation layer 
-        #get the num_sites
-        num_sites = self.get_num_sites(self.filename)
-        # Get the coordinates of grids
-        coordx, coordy = self._data['x'][0], self._data['y'][0]
-        # Initialize nucleation sites
-        init_nucl_coordx, init_nucl_coordy = heater_init(-5.0, 5.0, num_sites)
-        # Initialize the layer
-        nucleation_layer = dfun_init(coordx, coordy, init_nucl_coordx, init_nucl_coordy, seed_radius=0.1)
-        nucleation_layer[nucleation_layer>=0] = 1
-        nucleation_layer[nucleation_layer<0] = 0
-        nucleation_layer = torch.tensor(nucleation_layer).unsqueeze(0).unsqueeze(0)
-        #return self._transform(coords, vel, dfun, nucleation_layer, vel_label, dfun_label)
-        # Apply transformations to elements that require it
-        transformed_vel, transformed_dfun, transformed_layer, transformed_vel_label, transformed_dfun_label = self._transform(vel, dfun, nucleation_layer, vel_label, dfun_label)
-    
-        # Return all elements, combining transformed ones with the untransformed nucleation_layer
-        return  transformed_vel, transformed_dfun, transformed_layer, transformed_vel_label, transformed_dfun_label
+        nucleation_layer = self._nucleation_layer
+        return vel, dfun, nucleation_layer, vel_label, dfun_label
 
 
 class DiskTempVelDataset(DiskHDF5Dataset):
@@ -276,6 +377,10 @@ class DiskTempVelDataset(DiskHDF5Dataset):
     Velocities and temperatures are unknown. The model writes past
     predictions to reuse for future predictions.
     """
+    fields = ('temp', 'vel', 'dfun')
+    # what each tensor of a sample holds, see augment.BatchHFlip
+    outputs = ('coords', 'temp', 'vel', 'dfun', 'temp', 'vel')
+
     def __init__(self,
                  filename,
                  steady_time,
@@ -283,8 +388,9 @@ class DiskTempVelDataset(DiskHDF5Dataset):
                  transform=False,
                  time_window=1,
                  future_window=1,
-                 push_forward_steps=1):
-        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps)
+                 push_forward_steps=1,
+                 **kwargs):
+        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps, **kwargs)
         coords_dim = 2 if use_coords else 0
         self.temp_channels = self.time_window
         self.vel_channels = self.time_window * 2
@@ -293,28 +399,35 @@ class DiskTempVelDataset(DiskHDF5Dataset):
         self.in_channels = coords_dim + self.temp_channels + self.vel_channels + self.dfun_channels
         self.out_channels = 3 * self.future_window
 
-    def _get_timestep(self, timestep):
+    def _get_timestep(self, timestep, offset, temp_span, vel_span, dfun_span):
         r"""
-        Get the window rooted at timestep.
+        Get the window rooted at timestep, which is `offset` frames into the spans.
         This includes the {timestep - self.time_window, ..., timestep - 1} as input
         and {timestep, ..., timestep + future_window - 1} as output
         """
+        tw, fw = self.time_window, self.future_window
         coords = self._get_coords(timestep)
-        temp = torch.stack([self._get_temp(timestep + k) for k in range(self.time_window)], dim=0)
-        vel = torch.cat([self._get_vel_stack(timestep + k) for k in range(self.time_window)], dim=0) 
-        dfun = torch.stack([self._get_dfun(timestep + k) for k in range(self.time_window)], dim=0)
-
-        base_time = timestep + self.time_window 
-        temp_label = torch.stack([self._get_temp(base_time + k) for k in range(self.future_window)], dim=0)
-        vel_label = torch.cat([self._get_vel_stack(base_time + k) for k in range(self.future_window)], dim=0)
-        return self._transform(coords, temp, vel, dfun, temp_label, vel_label)
+        temp = temp_span[offset:offset + tw]
+        vel = vel_span[2 * offset:2 * (offset + tw)]
+        dfun = dfun_span[offset:offset + tw]
+        temp_label = temp_span[offset + tw:offset + tw + fw]
+        vel_label = vel_span[2 * (offset + tw):2 * (offset + tw + fw)]
+        return coords, temp, vel, dfun, temp_label, vel_label
 
     def __getitem__(self, timestep):
         r"""
         Get the windows rooted at {timestep, timestep + self.future_window, ...}
         For each variable, the windows are concatenated into one tensor.
+        Every frame used by the push-forward windows is read at once.
         """
-        args = list(zip(*[self._get_timestep(timestep + k * self.future_window) for k in range(self.push_forward_steps)]))
+        length = self.time_window + self.future_window * self.push_forward_steps
+        temp_span = self._get_temp_window(timestep, length)
+        vel_span = self._get_vel_window(timestep, length)
+        dfun_span = self._get_dfun_window(timestep, length)
+        args = list(zip(*[self._get_timestep(timestep + k * self.future_window,
+                                             k * self.future_window,
+                                             temp_span, vel_span, dfun_span)
+                          for k in range(self.push_forward_steps)]))
         return tuple([torch.stack(arg, dim=0) for arg in args])
 
     #def write_vel(self, vel, timestep):
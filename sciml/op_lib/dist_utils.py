@@ -1,4 +1,5 @@
 import os
+import torch
 import torch.distributed as dist
 
 def initialize(backend):
@@ -12,6 +13,14 @@ def local_rank():
         return 0
     return int(os.environ['LOCAL_RANK'])
 
+def local_device():
+    r"""
+    The GPU of this process, or the CPU if there is no GPU.
+    """
+    if not torch.cuda.is_available():
+        return torch.device('cpu')
+    return torch.device('cuda', local_rank())
+
 def rank():
     if not dist.is_initialized():
         return 0
@@ -27,3 +36,23 @@ def leader_rank():
 
 def is_leader_process():
     return rank() == leader_rank()
+
+def all_reduce_(tensor, op='sum'):
+    r"""
+    In-place all-reduce of tensor over the ranks ('sum' or 'max').
+    Does nothing if distributed training is not used.
+    """
+    if dist_is_used():
+        dist.all_reduce(tensor, op={'sum': dist.ReduceOp.SUM, 'max': dist.ReduceOp.MAX}[op])
+    return tensor
+
+def gather_to_leader(obj):
+    r"""
+    The list of obj of every rank on the leader, and None on the other ranks.
+    obj must be picklable.
+    """
+    if not dist_is_used():
+        return [obj]
+    objs = [None] * world_size() if is_leader_process() else None
+    dist.gather_object(obj, objs, dst=leader_rank())
+    return objs
@@ -1,7 +1,36 @@
+# downsampling methods the datasets support at load time
+POOLS = ('stride', 'avg')
 
-
-def downsample_domain(downsample_factor, *args):
+def as_factor(downsample_factor):
     if isinstance(downsample_factor, int):
         downsample_factor = [downsample_factor, downsample_factor]
     assert all([df >= 1 and isinstance(df, int) for df in downsample_factor])
+    return list(downsample_factor)
+
+def downsample_domain(downsample_factor, *args):
+    downsample_factor = as_factor(downsample_factor)
     return tuple([im[..., ::downsample_factor[0], ::downsample_factor[1]] for im in args])
+
+def pool_domain(downsample_factor, *args):
+    r"""
+    Average over downsample_factor[0] x downsample_factor[1] patches, which
+    anti-aliases the downsampled fields. Rows and columns that do not fill
+    a patch are dropped. Works on both numpy arrays and tensors.
+    """
+    rf, cf = as_factor(downsample_factor)
+    pooled = []
+    for im in args:
+        rows, cols = im.shape[-2] // rf, im.shape[-1] // cf
+        im = im[..., :rows * rf, :cols * cf].reshape(*im.shape[:-2], rows, rf, cols, cf)
+        pooled.append(im.mean((-3, -1)))
+    return tuple(pooled)
+
+def downsampled_size(downsample_factor, rows, cols, pool='stride'):
+    r"""
+    Size of a [rows x cols] domain after downsampling with pool.
+    """
+    assert pool in POOLS, f'unknown pool {pool}'
+    rf, cf = as_factor(downsample_factor)
+    if pool == 'avg':
+        return rows // rf, cols // cf
+    return len(range(0, rows, rf)), len(range(0, cols, cf))
@@ -1,17 +1,50 @@
+import os
+import numpy as np
 import torch
-from torch.utils.data import ConcatDataset, Dataset
+from torch.utils.data import ConcatDataset, Dataset, default_collate
 import h5py
-import random
 from torchvision.transforms import Resize
-import torchvision.transforms.functional as TF
 from pathlib import Path
 #for nucleation 
-from .nucleation import heater_init, dfun_init
+from .nucleation import cached_nucleation_layer
+from .shared_store import shared_key, shared_tensor
+from .downsample import as_factor, downsample_domain, pool_domain, downsampled_size
+from .stats import field_stats
 
 # The early timesteps of a simulation may be "unsteady"
 # We say that the simulation enters a steady state around
 # timestep 30.
 
+TWALL = 'Twall-'
+
+# storage dtype -> (dtype, largest quantization error relative to the field's absmax)
+STORAGE_DTYPES = {
+    'float32': (torch.float32, 1e-6),
+    'bfloat16': (torch.bfloat16, 4e-3),
+    'float16': (torch.float16, 1e-3),
+}
+
+def expand_vapor_mask(dfun):
+    r"""
+    The datasets keep dfun packed as its sign (int8). The models see
+    the vapor mask: 0.5 in vapor and -0.5 in liquid.
+    Tensors that are not packed are returned unchanged.
+    """
+    if dfun.dtype != torch.int8:
+        return dfun
+    return (dfun > 0).to(torch.float32).sub_(0.5)
+
+def collate(batch, augment=None):
+    r"""
+    Collate samples into a batch and expand the packed vapor masks.
+    Expanding after collation keeps the per-sample dfun at one byte per cell.
+    augment, e.g. augment.BatchHFlip, is applied to the whole batch.
+    """
+    batch = default_collate(batch)
+    if augment is not None:
+        batch = augment(batch)
+    return [expand_vapor_mask(t) for t in batch]
+
 class HDF5ConcatDataset(ConcatDataset):
     def __init__(self, datasets):
         super().__init__(datasets)
@@ -19,6 +52,9 @@ class HDF5ConcatDataset(ConcatDataset):
     def future_window(self):
         return self.datasets[0].future_window
 
+    def outputs(self):
+        return self.datasets[0].outputs
+
     def absmax_vel(self):
         return max(d.absmax_vel() for d in self.datasets)
 
@@ -43,44 +79,244 @@ class HDF5ConcatDataset(ConcatDataset):
         return self.datasets[0].datum_dim()
 
 class HDF5Dataset(Dataset):
+    # fields read from the hdf5 file. Subclasses only load what they use.
+    fields = ('temp', 'vel', 'dfun')
+    # positions of the rollout_inputs that are static in time
+    static_rollout_inputs = ()
+
     def __init__(self,
                  filename,
                  steady_time,
                  transform=False,
                  time_window=1,
                  future_window=1,
-                 push_forward_steps=1):
+                 push_forward_steps=1,
+                 shm_dir=None,
+                 downsample_factor=1,
+                 pool='stride',
+                 storage_dtype=None,
+                 stats_cache_dir=None):
         super().__init__()
         assert time_window > 0, 'HDF5Dataset.__init__():time window should be positive'
         self.filename = filename
         self.steady_time = steady_time
+        # samples are flipped after collation, see augment.BatchHFlip
+        assert not transform, 'transform is applied to batches, see augment.BatchHFlip'
         self.transform = transform
         self.time_window = time_window
         self.future_window = future_window
         self.push_forward_steps = push_forward_steps
+        # If set, the simulation is loaded once per node into shared memory
+        # and every worker/rank maps it read-only. See shared_store.py
+        self.shm_dir = shm_dir
+        # The fields are downsampled when they are loaded: 'stride' reads only
+        # the needed rows and columns, 'avg' averages patches of the full fields.
+        self.downsample_factor = as_factor(downsample_factor)
+        self.pool = pool
+        # Temperatures and velocities are stored in storage_dtype and read as
+        # float32. float16 fields are stored divided by their absmax, so they
+        # stay in its range. None keeps the dtype of the file.
+        assert storage_dtype is None or storage_dtype in STORAGE_DTYPES, f'unknown storage dtype {storage_dtype}'
+        self.storage_dtype = storage_dtype
+        self.stats_cache_dir = stats_cache_dir
+        # The stored data is never modified. Temperatures and velocities
+        # are normalized with these scales when they are read.
         self.temp_scale = None
         self.vel_scale = None
         self.reset()
 
     def reset(self):
         self._data = {}
+        self.reset_rollout()
         with h5py.File(self.filename, 'r') as f:
-            self._data['temp'] = torch.nan_to_num(torch.from_numpy(f['temperature'][:][self.steady_time:]))
-            self._data['velx'] = torch.nan_to_num(torch.from_numpy(f['velx'][:][self.steady_time:]))
-            self._data['vely'] = torch.nan_to_num(torch.from_numpy(f['vely'][:][self.steady_time:]))
-            self._data['dfun'] = torch.nan_to_num(torch.from_numpy(f['dfun'][:][self.steady_time:]))
-            self._data['x'] = torch.from_numpy(f['x'][:][self.steady_time:])
-            self._data['y'] = torch.from_numpy(f['y'][:][self.steady_time:])
-
-        self._redim_temp(self.filename)
-        if self.temp_scale and self.vel_scale:
-            self.normalize_temp_(self.temp_scale)
-            self.normalize_vel_(self.vel_scale)
+            num_frames, rows, cols = f['temperature'].shape
+            rows, cols = downsampled_size(self.downsample_factor, rows, cols, self.pool)
+            self._shape = torch.Size((num_frames - self.steady_time, rows, cols))
+            key = shared_key(Path(self.filename).resolve(),
+                             os.path.getmtime(self.filename),
+                             self.steady_time,
+                             self.downsample_factor,
+                             self.pool,
+                             self.storage_dtype)
+            self._store_scale = self._storage_scales()
+            for field in self.fields:
+                build = lambda: self._quantize(field, self._read_field(f, field))
+                if self.shm_dir is not None:
+                    self._data[field] = shared_tensor(self.shm_dir, key, field, build)
+                else:
+                    self._data[field] = build()
+            # the grid is static, so only one frame of x and y is kept
+            self._data['x'] = torch.from_numpy(f['x'][self.steady_time])
+            self._data['y'] = torch.from_numpy(f['y'][self.steady_time])
+
+        if 'vel' in self._data:
+            self._data['velx'] = self._data['vel'][:, 0]
+            self._data['vely'] = self._data['vel'][:, 1]
+
+        # the coordinates are normalized on the full grid, then downsampled
+        x, y = self._data['x'], self._data['y']
+        coords = torch.stack([x / x.max(), y / y.max()], dim=0).to(torch.float32)
+        self._coords = self._downsample(coords)
+
+    def _downsample(self, field):
+        if self.pool == 'avg':
+            return pool_domain(self.downsample_factor, field)[0]
+        return downsample_domain(self.downsample_factor, field)[0]
+
+    def _read(self, dset, sign=False):
+        r"""
+        Read frames steady_time onward of dset (or their sign), downsampled.
+        Strided downsampling is part of the hyperslab read.
+        """
+        rf, cf = self.downsample_factor if self.pool == 'stride' else (1, 1)
+        data = torch.from_numpy(dset[self.steady_time:, ::rf, ::cf]).nan_to_num_()
+        if sign:
+            data = data.sign_()
+        if self.pool == 'avg':
+            data = self._downsample(data)
+        return data
+
+    def _read_field(self, f, field):
+        r"""
+        Read a field from the open hdf5 file f. The steady_time cut is part
+        of the hyperslab read.
+        """
+        if field == 'temp':
+            return self._redim_temp(self._read(f['temperature']), self.filename)
+        if field == 'vel':
+            # velocities are stored interleaved as [T x 2 x H x W], so a window
+            # of frames is a view. velx and vely are views into this tensor.
+            if self.pool == 'avg':
+                return torch.stack([self._read(f['velx']), self._read(f['vely'])], dim=1)
+            rf, cf = self.downsample_factor
+            vel = np.empty((self._shape[0], 2, *self._shape[1:]), dtype=f['velx'].dtype)
+            f['velx'].read_direct(vel, np.s_[self.steady_time:, ::rf, ::cf], np.s_[:, 0])
+            f['vely'].read_direct(vel, np.s_[self.steady_time:, ::rf, ::cf], np.s_[:, 1])
+            return torch.from_numpy(vel).nan_to_num_()
+        if field == 'dfun':
+            # only the sign of dfun is used: it gives the vapor mask and the interface.
+            # Pooled cells are vapor if most of the patch is vapor.
+            dfun = self._read(f['dfun'], sign=True)
+            return torch.sign(dfun).to(torch.int8)
+        raise ValueError(f'unknown field {field}')
+
+    def _storage_scales(self):
+        r"""
+        The stored temperatures and velocities are divided by these scales.
+        They come from the cached file statistics, so every process that
+        maps a shared copy gets the same scales without reading the data.
+        """
+        scales = {'temp': 1.0, 'vel': 1.0}
+        if self.storage_dtype != 'float16':
+            return scales
+        for field in ('temp', 'vel'):
+            if field in self.fields:
+                low, high = self._file_range(field)
+                scales[field] = max(abs(low), abs(high)) or 1.0
+        return scales
+
+    def _file_range(self, field):
+        r"""
+        min and max of the full-resolution field ('temp' or 'vel') from the
+        cached file statistics. Temperatures are redimensionalized.
+        """
+        keys = ['temperature'] if field == 'temp' else ['velx', 'vely']
+        stats = field_stats(self.filename, keys, self.steady_time, self.stats_cache_dir).values()
+        scale = self._wall_temp() if field == 'temp' else 1
+        return min(s['min'] for s in stats) * scale, max(s['max'] for s in stats) * scale
+
+    def _range(self, field):
+        r"""
+        min and max of the unnormalized field. These are always those of the
+        full-resolution data, so the normalization scales do not depend on
+        how the fields are downsampled, and match the disk datasets. Fields
+        the dataset does not load also get their real range.
+        """
+        if self.downsample_factor != [1, 1] or field not in self._data:
+            return self._file_range(field)
+        data = self._data[field]
+        scale = self._store_scale[field]
+        return data.min().double() * scale, data.max().double() * scale
+
+    def _quantize(self, field, data):
+        r"""
+        Convert a field to the storage dtype and check the quantization error.
+        """
+        if self.storage_dtype is None or field not in self._store_scale:
+            return data
+        dtype, tolerance = STORAGE_DTYPES[self.storage_dtype]
+        scale = self._store_scale[field]
+        stored = (data / scale).to(dtype)
+        absmax = data.abs().max()
+        if absmax > 0:
+            error = ((stored.to(data.dtype) * scale - data).abs().max() / absmax).item()
+            print(f'{self.filename} {field} stored as {self.storage_dtype}, quantization error {error:.2e}')
+            assert error <= tolerance, f'{field} quantization error {error} exceeds {tolerance}'
+        return stored
+
+    def _float_dtype(self, stored):
+        r"""
+        dtype of the windows read from stored data
+        """
+        return torch.float32 if self.storage_dtype is not None else stored.dtype
+
+    def reset_rollout(self):
+        r"""
+        Discard predictions written during a rollout. The ground truth is
+        never modified by the writes, so there is nothing to reload.
+        """
+        # field -> {frame index -> predicted frame}
+        self._overlay = {}
 
     def datum_dim(self):
-        return self._data['temp'].size()
+        return self._shape
 
-    def _redim_temp(self, filename):
+    def _window(self, field, timestep, length, normalize=None):
+        r"""
+        Frames {timestep, ..., timestep + length - 1} of field, passed through
+        normalize. Without normalize, this is a view of the ground truth.
+        Frames overwritten by a rollout are filled in with the predictions.
+        If timestep is a tensor of timesteps, the windows of the batch
+        [B x length x ...] are gathered with a single index.
+        """
+        if torch.is_tensor(timestep):
+            return self._batch_window(field, timestep, length, normalize)
+        window = self._data[field][timestep:timestep + length]
+        if normalize is not None:
+            window = normalize(window)
+        overlay = self._overlay.get(field)
+        if overlay:
+            written = [k for k in range(length) if timestep + k in overlay]
+            if written:
+                if normalize is None:
+                    window = window.clone()
+                for k in written:
+                    window[k] = overlay[timestep + k]
+        return window
+
+    def _batch_window(self, field, timestep, length, normalize=None):
+        frames = timestep.unsqueeze(-1) + torch.arange(length, device=timestep.device)
+        window = self._data[field][frames]
+        if normalize is not None:
+            window = normalize(window)
+        for frame, pred in self._overlay.get(field, {}).items():
+            written = frames == frame
+            if written.any():
+                window[written] = pred.to(window.device, window.dtype)
+        return window
+
+    def _write(self, field, frames, timestep):
+        r"""
+        Record predicted frames for the future window rooted at timestep.
+        """
+        base_time = timestep + self.time_window
+        overlay = self._overlay.setdefault(field, {})
+        stored = self._data[field]
+        dtype = self._float_dtype(stored) if stored.is_floating_point() else stored.dtype
+        for k in range(self.future_window):
+            overlay[base_time + k] = frames[k].detach().to('cpu', dtype)
+
+    def _redim_temp(self, temp, filename):
         r"""
         Each hdf5 file non-dimensionalizes temperature to the same range. 
         If the wall temperature is varied across simulations, then the temperature
@@ -88,61 +324,148 @@ class HDF5Dataset(Dataset):
         simulations.
         this is ONLY DONE WHEN THE FILENAME INCLUDES Twall-
         """
-        filename = Path(filename).stem
-        wall_temp = None
-        TWALL = 'Twall-'
-        if TWALL in filename:
-            self._data['temp'] *= int(filename[len(TWALL):])
-            print('wall temp', self._data['temp'].max())
+        if TWALL in Path(filename).stem:
+            temp *= self._wall_temp()
+            print('wall temp', temp.max())
+        return temp
+
+    def _wall_temp(self):
+        filename = Path(self.filename).stem
+        if TWALL not in filename:
+            return 1
+        return int(filename[len(TWALL):])
 
     def absmax_temp(self):
-        return self._data['temp'].abs().max()
+        r"""
+        Absolute max of the temperatures, normalized if normalize_temp_ was called.
+        """
+        low, high = self._range('temp')
+        if self.temp_scale is None:
+            return max(abs(low), abs(high))
+        return max(abs(2 * low / self.temp_scale - 1), abs(2 * high / self.temp_scale - 1))
 
     def absmax_vel(self):
-        return max(self._data['velx'].abs().max(), self._data['vely'].abs().max())
+        low, high = self._range('vel')
+        absmax = max(abs(low), abs(high))
+        if self.vel_scale is None:
+            return absmax
+        return absmax / self.vel_scale
 
     def normalize_temp_(self, scale):
-        self._data['temp'] = 2 * (self._data['temp'] / scale) - 1
         self.temp_scale = scale
 
     def normalize_vel_(self, scale):
-        for v in ('velx', 'vely'):
-            self._data[v] = self._data[v] / scale
         self.vel_scale = scale
 
+    def _normalize_temp(self, temp):
+        r"""
+        Map temperatures to [-1, 1]. This always returns a new tensor.
+        """
+        assert self.temp_scale is not None, 'Normalize not called?'
+        temp = temp.to(self._float_dtype(temp), copy=True)
+        return temp.mul_(2 * self._store_scale['temp'] / self.temp_scale).sub_(1)
+
+    def _normalize_vel(self, vel):
+        assert self.vel_scale is not None, 'Normalize not called?'
+        vel = vel.to(self._float_dtype(vel), copy=True)
+        return vel.div_(self.vel_scale / self._store_scale['vel'])
+
+    def denormalize(self, field, frames):
+        r"""
+        Map normalized frames of field back to the units of the hdf5 file,
+        the inverse of the normalization of get_window. The sign of dfun
+        is all that is used, so dfun frames are returned as they are.
+        """
+        if field == 'temp':
+            return (frames + 1) * (self.temp_scale / (2 * self._wall_temp()))
+        if field == 'vel':
+            return frames * self.vel_scale
+        return frames
+
     def get_x(self):
-        return self._data['x'][self.time_window:]
+        r"""
+        x of frames time_window onward, normalized by its max and downsampled
+        like the coordinates the model sees. The grid is static, so this
+        is a view of one frame.
+        """
+        num_frames = self._shape[0] - self.time_window
+        return self._coords[0].expand(num_frames, *self._coords.shape[1:])
     
     def get_dy(self):
         r""" dy is the grid spacing in the y direction.
         """
-        return self._data['y'][0, 0, 0]
+        return self._data['y'][0, 0]
 
     def get_dfun(self):
-        return self._data['dfun'][self.time_window:]
+        r"""
+        The sign of dfun (float32) of frames time_window onward. This is
+        enough to find the liquid-vapor interface.
+        """
+        return self._data['dfun'][self.time_window:].to(torch.float32)
 
-    def _get_temp(self, timestep):
-        return self._data['temp'][timestep]
+    def _get_temp_window(self, timestep, length):
+        r"""
+        Temperatures of frames {timestep, ..., timestep + length - 1}.
+        """
+        return self._window('temp', timestep, length, self._normalize_temp)
 
-    def _get_vel_stack(self, timestep):
-        return torch.stack([
-            self._data['velx'][timestep],
-            self._data['vely'][timestep],
-        ], dim=0)
+    def _get_vel_window(self, timestep, length):
+        r"""
+        Velocities of `length` frames, interleaved as [velx_0, vely_0, velx_1, ...]
+        """
+        return self._window('vel', timestep, length, self._normalize_vel).flatten(-4, -3)
 
     def _get_coords(self, timestep):
-        x = self._data['x'][timestep]
-        x /= x.max()
-        y = self._data['y'][timestep]
-        y /= y.max()
-        coords = torch.stack([
-            x, y
-        ], dim=0)
-        return coords
-
-    def _get_dfun(self, timestep):
-        vapor_mask = self._data['dfun'][timestep] > 0
-        return vapor_mask.to(float) - 0.5
+        r"""
+        The normalized coordinates [2 x H x W] are static in time.
+        """
+        return self._static(self._coords, timestep)
+
+    def _static(self, tensor, timestep):
+        r"""
+        A tensor that is static in time, repeated for a batch of timesteps.
+        """
+        if torch.is_tensor(timestep):
+            return tensor.expand(len(timestep), *tensor.shape)
+        return tensor
+
+    def _get_dfun_window(self, timestep, length):
+        r"""
+        Packed vapor mask of `length` frames, see expand_vapor_mask.
+        """
+        return self._window('dfun', timestep, length)
+
+    def get_window(self, field, timestep, length):
+        r"""
+        Frames {timestep, ..., timestep + length - 1} of field ('temp', 'vel'
+        or 'dfun') as the model sees them, e.g. the labels of a rollout.
+        """
+        windows = {
+            'temp': self._get_temp_window,
+            'vel': self._get_vel_window,
+            'dfun': self._get_dfun_window,
+        }
+        return expand_vapor_mask(windows[field](timestep, length))
+
+    def rollout_inputs(self, timestep):
+        r"""
+        The inputs at timestep that a model does not predict, e.g. dfun
+        when only velocities are predicted. A rollout reads only these from
+        the dataset and keeps the predicted fields on the device.
+        """
+        raise NotImplementedError
+
+    def write_vel(self, vel, timestep):
+        r"""
+        Write interleaved velocity predictions [velx_0, vely_0, ...] for
+        the future window rooted at timestep.
+        """
+        self._write('vel', vel.reshape(-1, 2, *vel.shape[-2:]), timestep)
+
+    def write_temp(self, temp, timestep):
+        if temp.dim() == 2:
+            temp.unsqueeze_(-1)
+        self._write('temp', temp, timestep)
 
     def __len__(self):
         # len is the number of timesteps. Each prediction
@@ -150,13 +473,20 @@ class HDF5Dataset(Dataset):
         # the first few frames.
         # we may also predict several frames in the future, so we
         # can't include those in length
-        return self._data['temp'].size(0) - self.time_window - (self.future_window * self.push_forward_steps - 1) 
+        return self._shape[0] - self.time_window - (self.future_window * self.push_forward_steps - 1) 
 
-    def _transform(self, *args):
-        if self.transform:
-            if random.random() > 0.5:
-                args = tuple([TF.hflip(arg) for arg in args])
-        return args
+    def to(self, device):
+        r"""
+        Move the stored fields to device. Batches of timesteps are then
+        gathered on the device, see device_loader.DeviceLoader
+        """
+        for field in self.fields:
+            self._data[field] = self._data[field].to(device)
+        if 'vel' in self._data:
+            self._data['velx'] = self._data['vel'][:, 0]
+            self._data['vely'] = self._data['vel'][:, 1]
+        self._coords = self._coords.to(device)
+        return self
 
     def __getitem__(self, timestep):
         assert False, 'Not Implemented'
@@ -168,6 +498,12 @@ class TempInputDataset(HDF5Dataset):
     past predictions for temperature and using them to make future
     predictions.
     """
+    # dfun is only used for the interface metrics in test()
+    fields = ('temp', 'vel', 'dfun')
+    static_rollout_inputs = (0,)
+    # what each tensor of a sample holds, see augment.BatchHFlip
+    outputs = ('coords', 'temp', 'vel', 'temp')
+
     def __init__(self,
                  filename,
                  steady_time,
@@ -175,25 +511,23 @@ class TempInputDataset(HDF5Dataset):
                  transform=False,
                  time_window=1,
                  future_window=1,
-                 push_forward_steps=1):
-        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps)
+                 push_forward_steps=1,
+                 **kwargs):
+        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps, **kwargs)
         coords_dim = 2 if use_coords else 0
         self.in_channels = 3 * self.time_window + coords_dim + 2 * self.future_window
         self.out_channels = self.future_window
 
     def __getitem__(self, timestep):
         coords = self._get_coords(timestep)
-        temps = torch.stack([self._get_temp(timestep + k) for k in range(self.time_window)], dim=0)
-        vel = torch.cat([self._get_vel_stack(timestep + k) for k in range(self.time_window + self.future_window)], dim=0) 
+        temps = self._get_temp_window(timestep, self.time_window)
+        vel = self._get_vel_window(timestep, self.time_window + self.future_window)
         base_time = timestep + self.time_window 
-        label = torch.stack([self._get_temp(base_time + k) for k in range(self.future_window)], dim=0)
-        return (coords, *self._transform(temps, vel, label))
+        label = self._get_temp_window(base_time, self.future_window)
+        return coords, temps, vel, label
 
-    def write_temp(self, temp, timestep):
-        if temp.dim() == 2:
-            temp.unsqueeze_(-1)
-        base_time = timestep + self.time_window
-        self._data['temp'][base_time:base_time + self.future_window] = temp
+    def rollout_inputs(self, timestep):
+        return self._get_coords(timestep), self._get_vel_window(timestep, self.time_window + self.future_window)
 
 class TempVelDataset(HDF5Dataset):
     r"""
@@ -201,6 +535,11 @@ class TempVelDataset(HDF5Dataset):
     Velocities and temperatures are unknown. The model writes past
     predictions to reuse for future predictions.
     """
+    fields = ('temp', 'vel', 'dfun')
+    static_rollout_inputs = (0,)
+    # what each tensor of a sample holds, see augment.BatchHFlip
+    outputs = ('coords', 'temp', 'vel', 'dfun', 'temp', 'vel')
+
     def __init__(self,
                  filename,
                  steady_time,
@@ -208,8 +547,9 @@ class TempVelDataset(HDF5Dataset):
                  transform=False,
                  time_window=1,
                  future_window=1,
-                 push_forward_steps=1):
-        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps)
+                 push_forward_steps=1,
+                 **kwargs):
+        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps, **kwargs)
         coords_dim = 2 if use_coords else 0
         self.temp_channels = self.time_window
         self.vel_channels = self.time_window * 2
@@ -225,14 +565,14 @@ class TempVelDataset(HDF5Dataset):
         and {timestep, ..., timestep + future_window - 1} as output
         """
         coords = self._get_coords(timestep)
-        temp = torch.stack([self._get_temp(timestep + k) for k in range(self.time_window)], dim=0)
-        vel = torch.cat([self._get_vel_stack(timestep + k) for k in range(self.time_window)], dim=0) 
-        dfun = torch.stack([self._get_dfun(timestep + k) for k in range(self.time_window)], dim=0)
+        temp = self._get_temp_window(timestep, self.time_window)
+        vel = self._get_vel_window(timestep, self.time_window)
+        dfun = self._get_dfun_window(timestep, self.time_window)
 
         base_time = timestep + self.time_window 
-        temp_label = torch.stack([self._get_temp(base_time + k) for k in range(self.future_window)], dim=0)
-        vel_label = torch.cat([self._get_vel_stack(base_time + k) for k in range(self.future_window)], dim=0)
-        return self._transform(coords, temp, vel, dfun, temp_label, vel_label)
+        temp_label = self._get_temp_window(base_time, self.future_window)
+        vel_label = self._get_vel_window(base_time, self.future_window)
+        return coords, temp, vel, dfun, temp_label, vel_label
 
     def __getitem__(self, timestep):
         r"""
@@ -240,19 +580,11 @@ class TempVelDataset(HDF5Dataset):
         For each variable, the windows are concatenated into one tensor.
         """
         args = list(zip(*[self._get_timestep(timestep + k * self.future_window) for k in range(self.push_forward_steps)]))
-        return tuple([torch.stack(arg, dim=0) for arg in args])
+        return tuple([torch.stack(arg, dim=-4) for arg in args])
 
-    def write_vel(self, vel, timestep):
-        base_time = timestep + self.time_window
-        self._data['velx'][base_time:base_time + self.future_window] = vel[0::2]
-        self._data['vely'][base_time:base_time + self.future_window] = vel[1::2]
+    def rollout_inputs(self, timestep):
+        return self._get_coords(timestep), self._get_dfun_window(timestep, self.time_window)
 
-    def write_temp(self, temp, timestep):
-        if temp.dim() == 2:
-            temp.unsqueeze_(-1)
-        base_time = timestep + self.time_window
-        self._data['temp'][base_time:base_time + self.future_window] = temp
-        
 class VelInputDataset(HDF5Dataset):
     r""" 
     This is a dataset for predicting only velocity. It assumes that
@@ -260,6 +592,10 @@ class VelInputDataset(HDF5Dataset):
     past predictions for velocities and using them to make future
     predictions.
     """
+    fields = ('vel', 'dfun')
+    # what each tensor of a sample holds, see augment.BatchHFlip
+    outputs = ('vel', 'dfun', 'vel')
+
     def __init__(self,
                  filename,
                  steady_time,
@@ -267,27 +603,23 @@ class VelInputDataset(HDF5Dataset):
                  transform=False,
                  time_window=1,
                  future_window=1,
-                 push_forward_steps=1):
-        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps)
+                 push_forward_steps=1,
+                 **kwargs):
+        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps, **kwargs)
         self.in_channels = 3 * self.time_window  #2 for current velocity 1 for current dfun 
         self.out_channels =2 * self.future_window #for two future velocity vx and vy 
 
     def __getitem__(self, timestep):
         # past velocity
-        vel = torch.cat([self._get_vel_stack(timestep + k) for k in range(self.time_window)], dim=0)
+        vel = self._get_vel_window(timestep, self.time_window).unsqueeze(-4)
         base_time = timestep + self.time_window 
-        label = torch.cat([self._get_vel_stack(base_time + k) for k in range(self.future_window)], dim=0)
-        # past and future dfun
-        dfun = torch.stack([self._get_dfun(timestep + k) for k in range(self.time_window)], dim=0)
-        vel = vel.unsqueeze(0);
-        label = label.unsqueeze(0);
-        dfun = dfun.unsqueeze(0);
-        return self._transform(vel, dfun, label)
+        label = self._get_vel_window(base_time, self.future_window).unsqueeze(-4)
+        # past dfun
+        dfun = self._get_dfun_window(timestep, self.time_window).unsqueeze(-4)
+        return vel, dfun, label
 
-    def write_vel(self, vel, timestep):
-        base_time = timestep + self.time_window
-        self._data['velx'][base_time:base_time + self.future_window] = vel[0::2]
-        self._data['vely'][base_time:base_time + self.future_window] = vel[1::2]
+    def rollout_inputs(self, timestep):
+        return (self._get_dfun_window(timestep, self.time_window),)
 
 class VelCoordInputDataset(HDF5Dataset):
     r""" 
@@ -296,6 +628,11 @@ class VelCoordInputDataset(HDF5Dataset):
     past predictions for velocities and using them to make future
     predictions.
     """
+    fields = ('vel', 'dfun')
+    static_rollout_inputs = (0,)
+    # what each tensor of a sample holds, see augment.BatchHFlip
+    outputs = ('coords', 'vel', 'dfun', 'vel')
+
     def __init__(self,
                  filename,
                  steady_time,
@@ -303,26 +640,25 @@ class VelCoordInputDataset(HDF5Dataset):
                  transform=False,
                  time_window=1,
                  future_window=1,
-                 push_forward_steps=1):
-        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps)
+                 push_forward_steps=1,
+                 **kwargs):
+        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps, **kwargs)
         coords_dim = 2 if use_coords else 0
         self.in_channels = coords_dim + 3 * self.time_window #2 for current velocity 1 for current dfun 
         self.out_channels =2 * self.future_window #for two future velocity vx and vy 
 
     def __getitem__(self, timestep):
-        coords = self._get_coords(timestep).unsqueeze(0);
+        coords = self._get_coords(timestep).unsqueeze(-4)
         # past velocity
-        vel = torch.cat([self._get_vel_stack(timestep + k) for k in range(self.time_window)], dim=0).unsqueeze(0);
+        vel = self._get_vel_window(timestep, self.time_window).unsqueeze(-4)
         base_time = timestep + self.time_window 
-        label = torch.cat([self._get_vel_stack(base_time + k) for k in range(self.future_window)], dim=0).unsqueeze(0);
-        # past and future dfun
-        dfun = torch.stack([self._get_dfun(timestep + k) for k in range(self.time_window)], dim=0).unsqueeze(0);
-        return self._transform(coords, vel, dfun, label)
-    
-    def write_vel(self, vel, timestep):
-        base_time = timestep + self.time_window
-        self._data['velx'][base_time:base_time + self.future_window] = vel[0::2]
-        self._data['vely'][base_time:base_time + self.future_window] = vel[1::2]
+        label = self._get_vel_window(base_time, self.future_window).unsqueeze(-4)
+        # past dfun
+        dfun = self._get_dfun_window(timestep, self.time_window).unsqueeze(-4)
+        return coords, vel, dfun, label
+
+    def rollout_inputs(self, timestep):
+        return self._get_coords(timestep), self._get_dfun_window(timestep, self.time_window)
 
 class VelDfunDataset(HDF5Dataset):
     r""" 
@@ -331,6 +667,11 @@ class VelDfunDataset(HDF5Dataset):
     past predictions for velocities and dfun and using them to make future
     predictions. Nucleation layer is added as input
     """
+    fields = ('vel', 'dfun')
+    static_rollout_inputs = (0,)
+    # what each tensor of a sample holds, see augment.BatchHFlip
+    outputs = ('vel', 'dfun', 'nucleation', 'vel', 'dfun')
+
     def __init__(self,
                  filename,
                  steady_time,
@@ -338,69 +679,43 @@ class VelDfunDataset(HDF5Dataset):
                  transform=False,
                  time_window=1,
                  future_window=1,
-                 push_forward_steps=1):
-        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps)
+                 push_forward_steps=1,
+                 nucleation_cache_dir=None,
+                 **kwargs):
+        super().__init__(filename, steady_time, transform, time_window, future_window, push_forward_steps, **kwargs)
         self.filename = filename
+        # the nucleation layer only depends on the file and grid, so it is built once
+        coordx, coordy = self._data['x'].numpy(), self._data['y'].numpy()
+        layer = cached_nucleation_layer(filename, coordx, coordy, cache_dir=nucleation_cache_dir)
+        self._nucleation_layer = self._downsample(layer).to(self._float_dtype(layer))
         coords_dim = 2 if use_coords else 0
         self.in_channels = 3 * self.time_window + 1 #2 for current velocity 1 for current dfun 1 for nucleation layer
         self.out_channels =3 * self.future_window #for two future velocity vx and vy and one for future dfun
 
-    #added function to get num sites based on different files 
-    def get_num_sites(self, filename):
-        r"""
-        Extracts the Twall value from the filename and maps it to the corresponding
-        number of nucleation sites.
-        """
-        filename = Path(filename).stem
-        TWALL_PREFIX = 'Twall-'
-        # Define a mapping from Twall value to the number of nucleation sites.
-        twall_to_num_sites_map = {
-            '90': 15, '92': 17, '95': 19, '97': 21, '98': 22,
-            '100': 24, '102': 25, '106': 27, '108': 27, '110': 27
-        }
-        # Extract Twall value and convert it to an integer.
-        twall_value = filename.split(TWALL_PREFIX)[-1]
-        # Return the number of nucleation sites from the map.
-        return twall_to_num_sites_map.get(twall_value, 0) 
-        
     def __getitem__(self, timestep):
         # past velocity
-        vel = torch.cat([self._get_vel_stack(timestep + k) for k in range(self.time_window)], dim=0).unsqueeze(0)
+        vel = self._get_vel_window(timestep, self.time_window).unsqueeze(-4)
         base_time = timestep + self.time_window 
-        vel_label = torch.cat([self._get_vel_stack(base_time + k) for k in range(self.future_window)], dim=0).unsqueeze(0)
+        vel_label = self._get_vel_window(base_time, self.future_window).unsqueeze(-4)
         # past dfun
-        dfun = torch.stack([self._get_dfun(timestep + k) for k in range(self.time_window)], dim=0).unsqueeze(0)
-        dfun_label = torch.stack([self._get_dfun(base_time + k) for k in range(self.future_window)], dim=0).unsqueeze(0)
+        dfun = self._get_dfun_window(timestep, self.time_window).unsqueeze(-4)
+        dfun_label = self._get_dfun_window(base_time, self.future_window).unsqueeze(-4)
         
-        #for nucleation layer 
-        #get the num_sites
-        num_sites = self.get_num_sites(self.filename)
-        # Get the coordinates of grids
-        coordx, coordy = self._data['x'][0], self._data['y'][0]
-        # Initialize nucleation sites
-        init_nucl_coordx, init_nucl_coordy = heater_init(-5.0, 5.0, num_sites)
-        # Initialize the layer
-        nucleation_layer = dfun_init(coordx, coordy, init_nucl_coordx, init_nucl_coordy, seed_radius=0.1)
-        nucleation_layer[nucleation_layer>=0] = 1
-        nucleation_layer[nucleation_layer<0] = 0
-        nucleation_layer = torch.tensor(nucleation_layer).unsqueeze(0).unsqueeze(0)
-        #return self._transform(coords, vel, dfun, nucleation_layer, vel_label, dfun_label)
-        # Apply transformations to elements that require it
-        transformed_vel, transformed_dfun, transformed_layer, transformed_vel_label, transformed_dfun_label = self._transform(vel, dfun, nucleation_layer, vel_label, dfun_label)
-    
-        # Return all elements, combining transformed ones with the untransformed nucleation_layer
-        return  transformed_vel, transformed_dfun, transformed_layer, transformed_vel_label, transformed_dfun_label
-    
-    def write_vel(self, vel, timestep):
-        base_time = timestep + self.time_window
-        self._data['velx'][base_time:base_time + self.future_window] = vel[0::2]
-        self._data['vely'][base_time:base_time + self.future_window] = vel[1::2]
+        nucleation_layer = self._static(self._nucleation_layer, timestep)
+        return vel, dfun, nucleation_layer, vel_label, dfun_label
+
+    def rollout_inputs(self, timestep):
+        # the layer is stored as one [1 x H x W] window
+        return (self._static(self._nucleation_layer[0], timestep),)
+
+    def to(self, device):
+        self._nucleation_layer = self._nucleation_layer.to(device)
+        return super().to(device)
 
     def write_dfun(self, dfun, timestep):
         if dfun.dim() == 2:
             dfun.unsqueeze_(-1)
-        base_time = timestep + self.time_window
-        self._data['dfun'][base_time:base_time + self.future_window] = dfun
+        self._write('dfun', torch.sign(dfun), timestep)
 
 # if __name__ == '__main__':
 #     test_ds = VelDfunDataset('/share/crsp/lab/ai4ts/share/simul_ts_0.1/PoolBoiling-SubCooled-FC72-2D-0.1/Twall-103.hdf5', steady_time=300, use_coords=True, transform=False, time_window=5, future_window=5)
@@ -0,0 +1,140 @@
+import contextlib
+import time
+import torch
+
+class Instrumentation:
+    r"""
+    Named timing ranges for the train loop, on the CPU or the GPU. Each
+    range is an nvtx range on the GPU and a record_function in torch
+    profiler traces, and its host time is summed per name. Every
+    `interval` iterations, these are written as
+      - Time/<name>: mean ms per iteration spent in the range,
+      - Perf/samples_per_sec: throughput of the interval,
+      - Perf/data_wait_fraction: fraction of the interval spent waiting
+        for the data loader.
+    CUDA kernels run asynchronously, so without `sync` the time of a
+    range is the time to launch its kernels. sync=True synchronizes the
+    device at the end of each range, for accurate (but slower) timings.
+
+    If profile is set, the iterations of its schedule (wait, warmup,
+    active and repeat, see torch.profiler.schedule) are traced with
+    torch.profiler and written to profile.dir for tensorboard. Tracing
+    starts with start_profiler, so setup is left out.
+
+    Args:
+        writer (metric_logger.AsyncScalarWriter): Where the timings are written.
+        interval (int): Number of iterations per logged value.
+        sync (bool): Synchronize the device at the end of each range.
+        profile (dict): The torch.profiler trace window. None disables it.
+        log_dir (str): Default directory of the traces.
+    """
+    def __init__(self, writer, interval=1, sync=False, profile=None, log_dir='.'):
+        self.writer = writer
+        self.interval = interval
+        self.sync = sync and torch.cuda.is_available()
+        self.nvtx = torch.cuda.is_available()
+        self.profile = profile
+        self.log_dir = log_dir
+        self.profiler = None
+        self.reset()
+
+    def start_profiler(self):
+        r"""
+        Start tracing the iterations, if profile is set.
+        """
+        profile = self.profile
+        if profile and self.profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            trace_dir = profile.get('dir', None) or f'{self.log_dir}/profile'
+            self.profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=profile.get('wait', 1),
+                                                 warmup=profile.get('warmup', 1),
+                                                 active=profile.get('active', 3),
+                                                 repeat=profile.get('repeat', 1)),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir))
+            self.profiler.start()
+
+    def reset(self):
+        self.times = {}
+        self.samples = 0
+        self.count = 0
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def range(self, name):
+        if self.nvtx:
+            torch.cuda.nvtx.range_push(name)
+        start = time.perf_counter()
+        try:
+            with torch.profiler.record_function(name):
+                yield
+            if self.sync:
+                torch.cuda.synchronize()
+        finally:
+            self.times[name] = self.times.get(name, 0) + time.perf_counter() - start
+            if self.nvtx:
+                torch.cuda.nvtx.range_pop()
+
+    def iterate(self, loader, name='data_wait'):
+        r"""
+        Iterate over loader, timing each wait for a batch as the range name.
+        """
+        with self.range(name):
+            iterator = iter(loader)
+        while True:
+            with self.range(name):
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+            yield batch
+
+    def step(self, global_iter, num_samples):
+        r"""
+        End an iteration of num_samples samples.
+        """
+        if self.profiler is not None:
+            self.profiler.step()
+        self.samples += num_samples
+        self.count += 1
+        self.global_iter = global_iter
+        if self.count == self.interval:
+            self.flush()
+
+    def flush(self):
+        r"""
+        Write the timings since the last write.
+        """
+        if self.count == 0:
+            return
+        elapsed = time.perf_counter() - self.start
+        tags = ['Perf/samples_per_sec', 'Perf/data_wait_fraction']
+        values = [self.samples / elapsed, self.times.get('data_wait', 0) / elapsed]
+        for name, seconds in self.times.items():
+            tags.append(f'Time/{name}')
+            values.append(1000 * seconds / self.count)
+        self.writer.add_scalars(tags, torch.tensor(values), self.global_iter)
+        self.reset()
+
+    def pop_range(self, name):
+        r"""
+        The seconds spent in a range since the last write, which is then
+        left out of the next write.
+        """
+        return self.times.pop(name, 0)
+
+    def write_range(self, name, global_iter):
+        r"""
+        Write the time of a range that is not part of an iteration, e.g.
+        checkpointing, as Time/<name> in ms.
+        """
+        seconds = self.pop_range(name)
+        self.writer.add_scalars([f'Time/{name}'], torch.tensor([1000 * seconds]), global_iter)
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
@@ -0,0 +1,126 @@
+import queue
+import threading
+import torch
+
+from .metrics import mae, rmse, max_error
+from .dist_utils import all_reduce_, is_leader_process, world_size
+
+class AsyncScalarWriter:
+    r"""
+    Writes scalars to tensorboard from a background thread. Values are
+    handed over as one device tensor, and only the thread copies them to
+    the host, so the training loop never waits for the device.
+
+    Args:
+        writer (SummaryWriter): The tensorboard writer. None drops the
+            scalars, e.g. when only testing.
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def add_scalars(self, tags, values, global_step, log=()):
+        r"""
+        Write values[i] as tags[i]. The tags in log are also printed.
+        values must not be modified afterwards.
+        """
+        if self.writer is None:
+            return
+        self.queue.put((tags, values, global_step, log))
+
+    def _drain(self):
+        while True:
+            tags, values, global_step, log = self.queue.get()
+            try:
+                for tag, value in zip(tags, values.tolist()):
+                    self.writer.add_scalar(tag, value, global_step)
+                    if tag in log:
+                        print(f'{log[tag]}: {value}')
+            except Exception as e:
+                # keep draining, so flush never waits on a dead thread
+                print(f'could not write scalars at step {global_step}: {e!r}')
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        r"""
+        Wait until every queued scalar is written.
+        """
+        self.queue.join()
+        if self.writer is not None:
+            self.writer.flush()
+
+class MetricAccumulator:
+    r"""
+    Accumulates the metrics of write_metrics (MAE, RMSE and MaxERror of
+    each stage) and the loss on the device, and writes them every
+    `interval` iterations: MAE, RMSE and the loss are averaged over the
+    interval, MaxERror is the max of the interval. With interval=1 the
+    logged values are those of write_metrics.
+
+    Args:
+        writer (AsyncScalarWriter): Where the metrics are written.
+        name (str): The loss is printed as '{name} loss' and written as
+            Loss/{name}.
+        interval (int): Number of iterations per logged value.
+        reduce (bool): Average the values (and take the max of MaxERror)
+            over the ranks before they are written, and write them only
+            on the leader. Every rank must then call update and flush the
+            same number of times, e.g. with a DistributedSampler.
+    """
+    def __init__(self, writer, name, interval=1, reduce=False):
+        assert interval > 0
+        self.writer = writer
+        self.name = name
+        self.interval = interval
+        self.reduce = reduce
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.maxes = {}
+        self.count = 0
+
+    def _sum(self, tag, value):
+        value = value.detach().double()
+        self.sums[tag] = self.sums[tag] + value if tag in self.sums else value
+
+    def _max(self, tag, value):
+        value = value.detach().double()
+        self.maxes[tag] = torch.maximum(self.maxes[tag], value) if tag in self.maxes else value
+
+    def update(self, loss, metrics, global_iter):
+        r"""
+        Add the loss and the metrics (stage -> (pred, label)) of an
+        iteration, and write them at the end of an interval.
+        """
+        with torch.no_grad():
+            self._sum(f'Loss/{self.name}', loss)
+            for stage, (pred, label) in metrics.items():
+                self._sum(f'{stage}/MAE', mae(pred, label))
+                self._sum(f'{stage}/RMSE', rmse(pred, label))
+                self._max(f'{stage}/MaxERror', max_error(pred, label))
+        self.count += 1
+        self.global_iter = global_iter
+        if self.count == self.interval:
+            self.flush()
+
+    def flush(self):
+        r"""
+        Write what was accumulated since the last write, at the last
+        iteration that was added.
+        """
+        if self.count == 0:
+            return
+        tags = list(self.sums) + list(self.maxes)
+        means = torch.stack([value / self.count for value in self.sums.values()])
+        maxes = torch.stack(list(self.maxes.values())) if self.maxes else means[:0]
+        if self.reduce:
+            means = all_reduce_(means) / world_size()
+            maxes = all_reduce_(maxes, 'max')
+        if not self.reduce or is_leader_process():
+            values = torch.cat((means, maxes))
+            self.writer.add_scalars(tags, values, self.global_iter, log={f'Loss/{self.name}': f'{self.name} loss'})
+        self.reset()
@@ -6,9 +6,7 @@ take the same approach.
 import torch
 import torch.nn.functional as F
 from dataclasses import dataclass
-import math
-import numpy as np
-import numba as nb
+import functools
 
 from .losses import LpLoss
 
@@ -39,18 +37,148 @@ class Metrics:
         """
 
 def compute_metrics(pred, label, dfun):
-    low, mid, high = fourier_error(pred, label, 8, 8)
-    return Metrics(
-        mae=mae(pred, label),
-        rmse=rmse(pred, label),
-        relative_error=relative_error(pred, label),
-        max_error=max_error(pred, label),
-        boundary_rmse=boundary_rmse(pred, label),
-        interface_rmse=interface_rmse(pred, label, dfun),
-        fourier_low=low,
-        fourier_mid=mid,
-        fourier_high=high
-    )
+    return compute_field_metrics({'field': pred}, {'field': label}, dfun)['field']
+
+def compute_field_metrics(preds, labels, dfun):
+    r""" The Metrics of several fields of a rollout in one batched pass.
+    preds and labels map each field to its [t x h x w] frames, and the
+    fields share dfun. The error, squared error, its FFT and the interface
+    mask are computed once for every field, and each metric is a reduction
+    of them. Returns a dict field -> Metrics.
+    """
+    fields = list(preds)
+    frames = _frame_reductions(torch.stack([preds[field] for field in fields]),
+                               torch.stack([labels[field] for field in fields]),
+                               dfun)
+    return _reduce_frames(fields, frames, dfun.size()[1:])
+
+def _frame_reductions(pred, label, dfun):
+    r""" The reductions of each frame of pred and label [fields x t x h x w]
+    that the Metrics are computed from, as a dict of [fields x t] tensors
+    ([fields x t x bins] for the radially binned spectral error).
+    """
+    assert pred.size() == label.size()
+    assert pred.size()[1:] == dfun.size()
+    error = pred - label
+    squared_error = error ** 2
+    mask = get_interface_mask(dfun)
+    # the FFT is linear, so the spectral error is the FFT of the error
+    return {
+        'abs_error': error.abs().sum(dim=[-2, -1]),
+        'squared_error': squared_error.sum(dim=[-2, -1]),
+        'max_error': squared_error.amax(dim=[-2, -1]),
+        'label_norm': torch.norm(label.flatten(-2), p=2, dim=-1),
+        'boundary_se': _extract_boundary(squared_error).sum(dim=-1),
+        'interface_se': torch.where(mask, squared_error, 0).sum(dim=[-2, -1]),
+        'interface_size': mask.sum(dim=[-2, -1]).expand(pred.size(0), -1),
+        'spectrum': _radial_power(torch.abs(torch.fft.fftn(error, dim=[-2, -1])) ** 2),
+    }
+
+def _reduce_frames(fields, frames, domain_size):
+    r""" The Metrics of each field from the reductions of all its frames.
+    """
+    nx, ny = domain_size
+    num_frames = frames['squared_error'].size(1)
+    mae = frames['abs_error'].sum(dim=1) / (num_frames * nx * ny)
+    rmse = torch.sqrt(frames['squared_error'] / (nx * ny)).sum(dim=1) / num_frames
+    relative_error = (torch.sqrt(frames['squared_error']) / frames['label_norm']).mean(dim=1)
+    max_error = frames['max_error'].amax(dim=1)
+    boundary_rmse = torch.sqrt(frames['boundary_se'] / (2 * nx + 2 * ny)).sum(dim=1) / num_frames
+    interface_rmse = torch.sqrt(frames['interface_se'] / frames['interface_size']).sum(dim=1) / num_frames
+    low, mid, high = _bands(frames['spectrum'], nx, ny, 8, 8)
+    return {
+        field: Metrics(
+            mae=mae[i],
+            rmse=rmse[i],
+            relative_error=relative_error[i],
+            max_error=max_error[i],
+            boundary_rmse=boundary_rmse[i],
+            interface_rmse=interface_rmse[i],
+            fourier_low=low[i],
+            fourier_mid=mid[i],
+            fourier_high=high[i]
+        ) for i, field in enumerate(fields)
+    }
+
+class StreamingMetrics:
+    r""" Metrics of rollouts that do not fit in memory. update() takes the
+    frames of a rollout a few at a time, e.g. every rollout step, and only
+    keeps the reductions of each frame: the error sums, max, interface
+    sums and the radially binned spectral error, a few scalars (and bins)
+    per frame and field. Frames are indexed by their timestep, so partial
+    results of different workers or ranks merge exactly, in any order,
+    and the per-timestep RMSE curve is a by-product.
+
+    Args:
+        fields (list): Names of the fields.
+    """
+    def __init__(self, fields):
+        self.fields = list(fields)
+        self.timesteps = []
+        self.frames = []
+        self.domain_size = None
+
+    def update(self, preds, labels, dfun, timestep):
+        r""" Add the frames {timestep, ..., timestep + t - 1} of each field,
+        preds and labels map each field to its [t x h x w] frames.
+        """
+        pred = torch.stack([preds[field] for field in self.fields])
+        label = torch.stack([labels[field] for field in self.fields])
+        self.domain_size = dfun.size()[1:]
+        self.frames.append(_frame_reductions(pred, label, dfun))
+        self.timesteps.append(torch.arange(timestep, timestep + dfun.size(0)))
+
+    def state_dict(self):
+        r""" The reductions of every frame added, on the cpu.
+        """
+        timesteps, frames = self._gather()
+        return {
+            'fields': self.fields,
+            'domain_size': self.domain_size,
+            'timesteps': timesteps,
+            'frames': {key: value.cpu() for key, value in frames.items()},
+        }
+
+    def merge(self, state):
+        r""" Add the frames of another StreamingMetrics, e.g. its state_dict
+        from another rank.
+        """
+        if isinstance(state, StreamingMetrics):
+            state = state.state_dict()
+        assert state['fields'] == self.fields, 'StreamingMetrics.merge: different fields'
+        if len(state['timesteps']) == 0:
+            return
+        self.domain_size = state['domain_size']
+        self.timesteps.append(state['timesteps'])
+        self.frames.append(state['frames'])
+
+    def _gather(self):
+        r""" The reductions of all frames, in timestep order.
+        """
+        if not self.frames:
+            return torch.zeros(0, dtype=torch.long), {}
+        timesteps = torch.cat(self.timesteps)
+        order = timesteps.argsort()
+        assert (timesteps[order].diff() > 0).all(), 'StreamingMetrics: a timestep was added twice'
+        frames = {}
+        for key in self.frames[0]:
+            values = torch.cat([part[key].to(self.frames[0][key].device) for part in self.frames], dim=1)
+            frames[key] = values[:, order.to(values.device)]
+        return timesteps[order], frames
+
+    def compute(self):
+        r""" field -> Metrics of all frames added.
+        """
+        _, frames = self._gather()
+        return _reduce_frames(self.fields, frames, self.domain_size)
+
+    def frame_rmse(self):
+        r""" field -> [T] RMSE of each frame, in timestep order, as in plt_util.plt_iter_mae
+        """
+        timesteps, frames = self._gather()
+        nx, ny = self.domain_size
+        rmse = torch.sqrt(frames['squared_error'] / (nx * ny))
+        return {field: rmse[i] for i, field in enumerate(self.fields)}
 
 def write_metrics(pred, label, iter, stage, writer):
     writer.add_scalar(f'{stage}/MAE', mae(pred, label), iter)
@@ -94,58 +222,79 @@ def boundary_rmse(pred, label):
     assert pred.size() == label.size()
     bpred = _extract_boundary(pred)
     blabel = _extract_boundary(label)
-    print(bpred.size())
     return rmse(bpred, blabel) 
 
 def interface_rmse(pred, label, dfun):
     assert pred.size() == label.size()
     assert pred.size() == dfun.size()
-    mses = []
-    for i in range(pred.size(0)):
-        squared_error = (pred[i] - label[i]) ** 2
-        mask = torch.tensor(get_interface_mask(dfun[i].numpy()))
-        interface_mse = torch.mean(squared_error[mask])
-        mses.append(interface_mse)
-    return torch.sqrt(torch.tensor(mses)).sum() / pred.size(0)
-
-@nb.njit
+    mask = get_interface_mask(dfun)
+    squared_error = torch.where(mask, (pred - label) ** 2, 0)
+    interface_mse = squared_error.sum(dim=[-2, -1]) / mask.sum(dim=[-2, -1])
+    return torch.sqrt(interface_mse).sum() / pred.size(0)
+
 def get_interface_mask(dgrid):
-    interface = np.zeros(dgrid.shape).astype(np.bool_)
-    [rows, cols] = dgrid.shape
-    for i in range(rows):
-        for j in range(cols):
-            adj = ((i < rows - 1 and dgrid[i][j] * dgrid[i+1, j  ] <= 0) or
-                   (i > 0 and dgrid[i][j] * dgrid[i-1, j  ] <= 0) or
-                   (j < cols - 1 and dgrid[i][j] * dgrid[i,   j+1] <= 0) or
-                   (j > 0 and dgrid[i][j] * dgrid[i,   j-1] <= 0))
-            interface[i][j] = adj
+    r""" Cells of dgrid [... x h x w] next to the liquid-vapor interface:
+    the sign of dfun changes (or is zero) between the cell and one of
+    its four neighbors. Runs batched on the device of dgrid.
+    """
+    interface = torch.zeros(dgrid.size(), dtype=torch.bool, device=dgrid.device)
+    rows = dgrid[..., 1:, :] * dgrid[..., :-1, :] <= 0
+    interface[..., 1:, :] |= rows
+    interface[..., :-1, :] |= rows
+    cols = dgrid[..., :, 1:] * dgrid[..., :, :-1] <= 0
+    interface[..., :, 1:] |= cols
+    interface[..., :, :-1] |= cols
     return interface
 
+@functools.lru_cache(maxsize=None)
+def _radial_bins(nx, ny, device):
+    r""" The modes (i, j), i < nx // 2 and j < ny // 2, that fall in a
+    radial bin floor(sqrt(i^2 + j^2)) < min(nx // 2, ny // 2), as flat
+    indices into the [nx // 2 x ny // 2] modes, and their bins.
+    """
+    i = torch.arange(nx // 2, dtype=torch.float64).unsqueeze(1)
+    j = torch.arange(ny // 2, dtype=torch.float64).unsqueeze(0)
+    bins = torch.sqrt(i ** 2 + j ** 2).floor().long().flatten()
+    modes = (bins < min(nx // 2, ny // 2)).nonzero().squeeze(1)
+    return modes.to(device), bins[modes].to(device)
+
 def fourier_error(pred, target, Lx, Ly):
     r""" This function is taken and modified from PDEBench
     https://github.com/pdebench/PDEBench/blob/main/pdebench/models/metrics.py
     """
-    ILOW = 4
-    IHIGH = 12
-
     assert pred.dim() == 3
     assert pred.size() == target.size()
     pred_F = torch.fft.fftn(pred, dim=[1, 2])
     target_F = torch.fft.fftn(target, dim=[1, 2])
-    idxs = target.size()
-    nb = target.size(0)
-    nx, ny = idxs[1:3]
-    print(nx, ny)
     _err_F = torch.abs(pred_F - target_F) ** 2
-    err_F = torch.zeros((nb, min(nx // 2, ny // 2)))
-    for i in range(nx // 2):
-        for j in range(ny // 2):
-            it = math.floor(math.sqrt(i ** 2 + j ** 2))
-            if it > min(nx // 2, ny // 2) - 1:
-                continue
-            err_F[:, it] += _err_F[:, i, j]
-    _err_F = torch.sqrt(torch.mean(err_F, axis=0)) / (nx * ny) * Lx * Ly
-    low_err = torch.mean(_err_F[:ILOW])
-    mid_err = torch.mean(_err_F[ILOW:IHIGH])
-    high_err = torch.mean(_err_F[IHIGH:])
+    return _fourier_bands(_err_F, Lx, Ly)
+
+def _fourier_bands(power, Lx, Ly):
+    r""" Low, mid and high band errors of the spectral error power
+    [... x b x h x w], summed in radial bins and averaged over b.
+    """
+    nx, ny = power.shape[-2:]
+    return _bands(_radial_power(power), nx, ny, Lx, Ly)
+
+def _radial_power(power):
+    r""" The spectral error power [... x h x w] summed in the radial bins
+    of _radial_bins, [... x min(h // 2, w // 2)].
+    """
+    nx, ny = power.shape[-2:]
+    modes, bins = _radial_bins(nx, ny, power.device)
+    err_F = power.new_zeros((*power.shape[:-2], min(nx // 2, ny // 2)))
+    err_F.index_add_(err_F.dim() - 1, bins, power[..., :nx // 2, :ny // 2].flatten(-2)[..., modes])
+    return err_F
+
+def _bands(err_F, nx, ny, Lx, Ly):
+    r""" Low, mid and high band errors of the radially binned spectral
+    error power [... x b x bins], averaged over b.
+    """
+    ILOW = 4
+    IHIGH = 12
+
+    _err_F = torch.sqrt(torch.mean(err_F, dim=-2)) / (nx * ny) * Lx * Ly
+    low_err = torch.mean(_err_F[..., :ILOW], dim=-1)
+    mid_err = torch.mean(_err_F[..., ILOW:IHIGH], dim=-1)
+    high_err = torch.mean(_err_F[..., IHIGH:], dim=-1)
     return low_err, mid_err, high_err
@@ -0,0 +1,148 @@
+import os
+import json
+import numpy as np
+import torch
+from pathlib import Path
+
+from .downsample import as_factor, downsampled_size
+from .disk_hdf5_dataset import (
+    DiskHDF5Dataset,
+    DiskTempInputDataset,
+    DiskTempVelDataset,
+    DiskVelInputDataset,
+    DiskVelCoordInputDataset,
+    DiskVelDfunDataset
+)
+
+MANIFEST = 'manifest.json'
+
+def mmap_path(filename, mmap_dir=None):
+    r"""
+    The store written by scripts/convert_mmap.py for a simulation. filename
+    can be the hdf5 file or the store itself. By default, the store is
+    next to the hdf5 file.
+    """
+    filename = Path(filename)
+    if filename.suffix == '.mmap':
+        return filename
+    parent = Path(mmap_dir) if mmap_dir else filename.parent
+    return parent / f'{filename.stem}.mmap'
+
+class MmapDataset(DiskHDF5Dataset):
+    r"""
+    Reads the same samples as DiskHDF5Dataset from a memory-mapped tensor store.
+    Windows are numpy views of the page cache, so a read is just the
+    normalization. Use it as the first base of a Disk*Dataset, e.g.
+    class MmapTempVelDataset(DiskTempVelDataset, MmapDataset), so the
+    dataset's __getitem__ reads through these methods.
+    """
+    def __init__(self,
+                 filename,
+                 steady_time,
+                 transform=False,
+                 time_window=1,
+                 future_window=1,
+                 push_forward_steps=1,
+                 mmap_dir=None,
+                 downsample_factor=1,
+                 pool='stride'):
+        assert time_window > 0, 'MmapDataset.__init__():time window should be positive'
+        self.filename = filename
+        self.steady_time = steady_time
+        # samples are flipped after collation, see augment.BatchHFlip
+        assert not transform, 'transform is applied to batches, see augment.BatchHFlip'
+        self.transform = transform
+        self.time_window = time_window
+        self.future_window = future_window
+        self.push_forward_steps = push_forward_steps
+        self.downsample_factor = as_factor(downsample_factor)
+        self.pool = pool
+
+        self.path = mmap_path(filename, mmap_dir)
+        with open(self.path / MANIFEST) as f:
+            self.manifest = json.load(f)
+        num_frames, rows, cols = self.manifest['shape']
+        self._shape = (num_frames, *downsampled_size(self.downsample_factor, rows, cols, pool))
+
+        # the arrays are mapped lazily in each process that reads from them
+        self._file = None
+        self._pid = None
+        x = torch.from_numpy(np.load(self.path / 'x.npy'))
+        y = torch.from_numpy(np.load(self.path / 'y.npy'))
+        self._grid = (x, y)
+        coords = torch.stack([x / x.max(), y / y.max()], dim=0).to(torch.float32)
+        self._coords = self._downsample(coords)
+
+        self.wall_temp = self._get_wall_temp(filename)
+        self.temp_scale = None
+        self.vel_scale = None
+
+    def open(self):
+        r"""
+        Map the arrays of the store in the current process.
+        """
+        self._file = {
+            field: np.load(self.path / meta['file'], mmap_mode='r')
+            for field, meta in self.manifest['fields'].items()
+        }
+        self._pid = os.getpid()
+
+    def close(self):
+        self._file = None
+        self._pid = None
+
+    def _index_data(self, key, timestep):
+        if key in ('x', 'y'):
+            # the grid is static, so only one frame is stored
+            return self._data[key]
+        return super()._index_data(key, timestep)
+
+    def _stats(self, field, key):
+        return np.array(self.manifest['fields'][field]['stats'][key][self.steady_time:])
+
+    def absmax_temp(self):
+        absmax = np.maximum(np.abs(self._stats('temperature', 'min')), np.abs(self._stats('temperature', 'max')))
+        return absmax.max() * self.wall_temp
+
+    def absmax_vel(self):
+        return max(np.abs(self._stats('vel', 'min')).max(), np.abs(self._stats('vel', 'max')).max())
+
+    def get_dy(self):
+        return self._data['y'][0, 0]
+
+    def _get_temp_window(self, timestep, length):
+        assert self.temp_scale is not None, 'Normalize not called?'
+        temp = self._pool(self._index_window('temperature', timestep, length))
+        return torch.from_numpy(np.multiply(temp, 2 * self.wall_temp / self.temp_scale)).sub_(1)
+
+    def _get_vel_window(self, timestep, length):
+        r"""
+        Velocities for `length` frames, interleaved as [velx_0, vely_0, velx_1, ...]
+        """
+        assert self.vel_scale is not None, 'Normalize not called?'
+        vel = np.divide(self._pool(self._index_window('vel', timestep, length)), self.vel_scale)
+        return torch.from_numpy(vel).flatten(0, 1)
+
+    def _get_dfun_window(self, timestep, length):
+        r"""
+        Packed vapor mask (the sign of dfun), see hdf5_dataset.expand_vapor_mask
+        """
+        dfun = self._index_window('dfun', timestep, length)
+        if self.pool == 'avg':
+            return torch.from_numpy(np.sign(self._pool(dfun)).astype(np.int8))
+        return torch.from_numpy(np.array(dfun))
+
+class MmapTempInputDataset(DiskTempInputDataset, MmapDataset):
+    pass
+
+class MmapTempVelDataset(DiskTempVelDataset, MmapDataset):
+    pass
+
+class MmapVelInputDataset(DiskVelInputDataset, MmapDataset):
+    pass
+
+class MmapVelCoordInputDataset(DiskVelCoordInputDataset, MmapDataset):
+    pass
+
+class MmapVelDfunDataset(DiskVelDfunDataset, MmapDataset):
+    pass
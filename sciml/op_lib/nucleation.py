@@ -1,10 +1,30 @@
+import os
+import hashlib
+from pathlib import Path
 import h5py as h5
 import numpy as np
+import torch
 from scipy.stats import qmc
 import matplotlib.pyplot as plt
 
 DX = 0.03125 # Grid spacing in FlashX simulations
 
+# Maps the Twall value in a filename to the number of nucleation sites.
+TWALL_TO_NUM_SITES = {
+    '90': 15, '92': 17, '95': 19, '97': 21, '98': 22,
+    '100': 24, '102': 25, '106': 27, '108': 27, '110': 27
+}
+
+def get_num_sites(filename):
+    r"""
+    Extracts the Twall value from the filename and maps it to the corresponding
+    number of nucleation sites.
+    """
+    filename = Path(filename).stem
+    TWALL_PREFIX = 'Twall-'
+    twall_value = filename.split(TWALL_PREFIX)[-1]
+    return TWALL_TO_NUM_SITES.get(twall_value, 0)
+
 def heater_init(xmin, xmax, num_sites):
     r"""
     Initialize the nucleation sites on the 1-D heater. Returns a 1D line of sites
@@ -53,6 +73,55 @@ def dfun_init(x_grid, y_grid, x_sites, y_sites, seed_radius):
         dfun = np.maximum(dfun, interim_dfun)
     return dfun
 
+def nucleation_layer(x_grid, y_grid, num_sites, seed_radius=0.1):
+    r"""
+    Binary layer marking the initial nucleation seeds on the heater.
+    Cells inside a seed are 1 and all other cells are 0.
+    """
+    x_sites, y_sites = heater_init(-5.0, 5.0, num_sites)
+    layer = dfun_init(x_grid, y_grid, x_sites, y_sites, seed_radius=seed_radius)
+    layer[layer >= 0] = 1
+    layer[layer < 0] = 0
+    return layer
+
+def cached_nucleation_layer(filename, x_grid, y_grid, cache_dir=None, seed_radius=0.1):
+    r"""
+    The nucleation layer only depends on the simulation file and its grid,
+    so it is built once per dataset rather than once per sample.
+    The layer is returned as a [1 x 1 x h x w] tensor in shared memory, so
+    DataLoader workers read the same copy.
+
+    Args:
+        filename (str): Path of the simulation, used to get the number of sites.
+        x_grid (numpy.ndarray): The x-coordinates of the grid.
+        y_grid (numpy.ndarray): The y-coordinates of the grid.
+        cache_dir (str): If set, the layer is also stored in a sidecar file in
+            this directory, keyed by the simulation path and grid shape.
+        seed_radius (float): The radius of the nucleation site.
+    """
+    x_grid = np.asarray(x_grid)
+    y_grid = np.asarray(y_grid)
+    num_sites = get_num_sites(filename)
+    cache_path = None
+    if cache_dir is not None:
+        key = f'{Path(filename).resolve()}:{x_grid.shape}:{num_sites}:{seed_radius}'
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        rows, cols = x_grid.shape
+        cache_path = Path(cache_dir) / f'{Path(filename).stem}_nucl_{rows}x{cols}_{digest}.npy'
+
+    if cache_path is not None and cache_path.exists():
+        layer = np.load(cache_path)
+    else:
+        layer = nucleation_layer(x_grid, y_grid, num_sites, seed_radius)
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            # write then rename, so concurrent ranks never see a partial file
+            tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as f:
+                np.save(f, layer)
+            os.replace(tmp_path, cache_path)
+    return torch.from_numpy(layer).unsqueeze(0).unsqueeze(0).share_memory_()
+
 def tag_renucleation(x_sites, y_sites, dfun, coordx, coordy, seed_radius, curr_iter, nuc_wait_time=0.4):
     r"""
     Tag the nucleation sites for renucleation after a certain time.
@@ -0,0 +1,163 @@
+import torch
+from .hdf5_dataset import expand_vapor_mask
+
+class RingBuffer:
+    r"""
+    Sliding window of the last `channels` channels of a field, [N x C x H x W].
+    The buffer holds the window twice, so the window is always the view
+    buffer[:, head:head + C], in order, and push writes the new frames in
+    place instead of shifting or concatenating the history.
+    """
+    def __init__(self, window):
+        self.channels = window.size(1)
+        self.buffer = torch.cat((window, window), dim=1)
+        self.head = 0
+
+    def window(self):
+        return self.buffer[:, self.head:self.head + self.channels]
+
+    def push(self, frames):
+        r"""
+        Drop the oldest frames.size(1) channels of the window and append frames.
+        """
+        channels = self.channels
+        if frames.size(1) >= channels:
+            self.buffer[:, :channels] = frames[:, -channels:]
+            self.buffer[:, channels:] = frames[:, -channels:]
+            self.head = 0
+            return
+        self.head = (self.head + frames.size(1)) % channels
+        start = self.head + channels - frames.size(1)
+        end = start + frames.size(1)
+        self.buffer[:, start:end] = frames
+        # keep both copies of the window in sync
+        lo, hi = start, min(end, channels)
+        if lo < hi:
+            self.buffer[:, lo + channels:hi + channels] = frames[:, :hi - lo]
+        lo, hi = max(start, channels), end
+        if lo < hi:
+            self.buffer[:, lo - channels:hi - channels] = frames[:, lo - start:]
+
+class Rollout:
+    r"""
+    Autoregressive rollout of N trajectories at once. A trajectory is a
+    (dataset, start timestep) pair, so N can be N simulations, N start
+    times in one simulation, or both. The predicted fields are kept on the
+    device as one [N x C x H x W] RingBuffer per field, and every step
+    advances all trajectories with one model call. After the first step,
+    only the inputs that are not predicted (e.g. dfun of VelInputDataset)
+    are read from the datasets, see HDF5Dataset.rollout_inputs, and of
+    these only the ones that change in time are copied to the device.
+
+    The trainer supplies the field-specific parts:
+      - history(sample): the initial history of each predicted field,
+        field -> [N x C x H x W], from the samples at the start times,
+      - step(inputs, history): the predictions of the next future window,
+        field -> [N x C x H x W], from the dataset's rollout_inputs,
+      - feedback(field, pred): how a prediction is fed back as input.
+
+    Args:
+        history (callable): See above.
+        step (callable): See above.
+        future_window (int): Number of frames predicted per step.
+        device (torch.device): Device the rollout runs on.
+        feedback (callable): See above. None feeds predictions back as is.
+    """
+    def __init__(self, history, step, future_window, device, feedback=None):
+        self.history = history
+        self.step = step
+        self.future_window = future_window
+        self.device = device
+        self.feedback = feedback if feedback is not None else lambda field, pred: pred
+
+    def _gather(self, datasets, timesteps, read, skip=()):
+        r"""
+        read(dataset, timesteps) of every trajectory, batched on the device.
+        Trajectories that share a dataset are read with one batched index.
+        Packed dfun is copied to the device as is and expanded there.
+        The outputs at the positions in skip are not copied (None).
+        """
+        groups = {}
+        for i, dataset in enumerate(datasets):
+            groups.setdefault(id(dataset), (dataset, []))[1].append(i)
+        order, parts = [], []
+        for dataset, idx in groups.values():
+            parts.append(read(dataset, timesteps[idx]))
+            order.extend(idx)
+        inverse = torch.tensor(order).argsort()
+        sample = []
+        for i, tensors in enumerate(zip(*parts)):
+            if i in skip:
+                sample.append(None)
+                continue
+            tensor = torch.cat(tensors, dim=0)[inverse.to(tensors[0].device)]
+            sample.append(expand_vapor_mask(tensor.to(self.device, non_blocking=True)).float())
+        return sample
+
+    @torch.no_grad()
+    def run(self, datasets, starts, num_steps, writers=None):
+        r"""
+        Roll out num_steps steps of future_window frames from each start.
+
+        Args:
+            datasets (list): The dataset of each trajectory. A dataset can
+                be repeated to roll out several start times.
+            starts (list): The start timestep of each trajectory.
+            num_steps (int): Number of model calls.
+            writers (list): Optional rollout_writer.RolloutWriter or
+                RolloutMetrics of each trajectory (or None to skip one).
+                The predictions of each step are streamed to the writers
+                instead of kept, so memory does not grow with num_steps,
+                and nothing is returned.
+        Returns:
+            preds: dict field -> [N x num_steps * C x H x W] on the device.
+                The frames of each step follow each other along dim 1, as
+                in the dataset windows.
+            labels: the ground truth of preds, read once from the datasets
+                after the rollout. These stay on the host.
+        """
+        assert len(datasets) == len(starts), 'Rollout.run: one start per dataset'
+        assert writers is None or len(writers) == len(datasets), 'Rollout.run: one writer per dataset'
+        starts = torch.tensor(starts, dtype=torch.long)
+        for dataset, start in zip(datasets, starts.tolist()):
+            assert start + (num_steps - 1) * self.future_window < len(dataset), 'Rollout.run: rollout is longer than the dataset'
+
+        sample = self._gather(datasets, starts, lambda dataset, timesteps: dataset[timesteps])
+        history = {field: RingBuffer(window) for field, window in self.history(sample).items()}
+        del sample
+
+        # inputs that are static in time (e.g. coords) are copied once
+        static = set(datasets[0].static_rollout_inputs)
+        cache = None
+        preds = {}
+        for k in range(num_steps):
+            inputs = self._gather(datasets,
+                                  starts + k * self.future_window,
+                                  lambda dataset, timesteps: dataset.rollout_inputs(timesteps),
+                                  skip=static if cache is not None else ())
+            if cache is None:
+                cache = {i: inputs[i] for i in static}
+            inputs = [cache.get(i, input) for i, input in enumerate(inputs)]
+            step_preds = self.step(inputs, {field: buffer.window() for field, buffer in history.items()})
+            if writers is not None:
+                for i, writer in enumerate(writers):
+                    if writer is not None:
+                        writer.write(k, {field: frames[i] for field, frames in step_preds.items()})
+            else:
+                for field, frames in step_preds.items():
+                    channels = frames.size(1)
+                    if field not in preds:
+                        # preallocated for the whole rollout
+                        preds[field] = frames.new_empty(frames.size(0), num_steps * channels, *frames.shape[2:])
+                    preds[field][:, k * channels:(k + 1) * channels] = frames
+            for field, buffer in history.items():
+                buffer.push(self.feedback(field, step_preds[field]))
+
+        if writers is not None:
+            return None
+        labels = {}
+        length = num_steps * self.future_window
+        for field in preds:
+            labels[field] = torch.stack([dataset.get_window(field, start + dataset.time_window, length).float()
+                                         for dataset, start in zip(datasets, starts.tolist())])
+        return preds, labels
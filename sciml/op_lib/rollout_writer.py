@@ -0,0 +1,206 @@
+import h5py
+import numpy as np
+import torch
+
+from .metrics import StreamingMetrics
+
+# predicted field -> datasets of the simulation file. vel is interleaved.
+FIELD_KEYS = {
+    'temp': ('temperature',),
+    'vel': ('velx', 'vely'),
+    'dfun': ('dfun',),
+}
+
+class RolloutWriter:
+    r"""
+    Streams the predictions of one rollout trajectory into an hdf5 file
+    with the layout of the simulation it starts from, so the file can be
+    read by HDF5Dataset and the plotting scripts. Frame i of the file is
+    frame start + i of the dataset: the first time_window frames are the
+    ground truth the rollout starts from, the following ones are the
+    predictions, written step by step, so memory does not grow with the
+    length of the rollout.
+
+    Fields that are not predicted (e.g. pressure, or dfun when only
+    velocities are predicted), the grid and the runtime parameters are
+    copied from the simulation, downsampled like the dataset.
+    Predictions are mapped back to the units of the simulation file, see
+    HDF5Dataset.denormalize, so steady_time=0 and the scales of the
+    training set recover them. Keep the Twall- stem of the simulation, it
+    sets the wall temperature.
+
+    Optionally, the file also gets
+      - label/<key>: the ground truth of the predicted frames,
+      - metrics/<key>_rmse and metrics/<key>_mae: per-frame errors of the
+        predictions, as the model sees them (normalized).
+
+    Args:
+        path (str): The file to write.
+        dataset (HDF5Dataset): The dataset of the trajectory.
+        start (int): The start timestep of the trajectory.
+        num_steps (int): Number of rollout steps.
+        future_window (int): Number of frames predicted per step.
+        labels (bool): Write the labels.
+        metrics (bool): Write the per-frame metrics.
+        compression (str): hdf5 compression filter, e.g. gzip. None writes
+            the data uncompressed.
+        chunk_frames (int): Number of frames copied at once from the simulation.
+    """
+    def __init__(self,
+                 path,
+                 dataset,
+                 start,
+                 num_steps,
+                 future_window,
+                 labels=False,
+                 metrics=False,
+                 compression=None,
+                 chunk_frames=64):
+        self.dataset = dataset
+        self.start = start
+        self.future_window = future_window
+        self.labels = labels
+        self.metrics = metrics
+        self.history = dataset.time_window
+        self.num_frames = self.history + num_steps * future_window
+        _, rows, cols = dataset.datum_dim()
+        self.shape = (self.num_frames, rows, cols)
+        self.compression = compression
+        self.chunk_frames = chunk_frames
+        self.file = h5py.File(path, 'w')
+        self._written = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _frames(self, key):
+        r"""
+        A [num_frames x H x W] dataset of the output, chunked by frame.
+        """
+        return self.file.require_dataset(key,
+                                         shape=self.shape,
+                                         dtype=np.float32,
+                                         chunks=(1, *self.shape[1:]),
+                                         compression=self.compression)
+
+    def _copy(self, src, key, end):
+        r"""
+        Copy frames [0, end) of the trajectory from the simulation dataset src.
+        """
+        dst = self._frames(key)
+        first = self.dataset.steady_time + self.start
+        for lo in range(0, end, self.chunk_frames):
+            hi = min(lo + self.chunk_frames, end)
+            frames = torch.from_numpy(src[first + lo:first + hi]).float()
+            dst[lo:hi] = self.dataset._downsample(frames).numpy()
+
+    def write(self, step, preds):
+        r"""
+        Write the predictions of rollout step `step`.
+
+        Args:
+            step (int): The rollout step.
+            preds (dict): field -> [C x H x W] predictions of the step.
+        """
+        lo = self.history + step * self.future_window
+        hi = lo + self.future_window
+        timestep = self.start + lo
+        for field, frames in preds.items():
+            keys = FIELD_KEYS[field]
+            frames = frames.detach().float().cpu()
+            self._written.add(field)
+            if self.labels or self.metrics:
+                label = self.dataset.get_window(field, timestep, self.future_window).float()
+            values = self.dataset.denormalize(field, frames)
+            for i, key in enumerate(keys):
+                self._frames(key)[lo:hi] = values[i::len(keys)].numpy()
+                if self.labels:
+                    self.file.require_dataset(f'label/{key}',
+                                              shape=(self.num_frames - self.history, *self.shape[1:]),
+                                              dtype=np.float32,
+                                              chunks=(1, *self.shape[1:]),
+                                              compression=self.compression)
+                    truth = self.dataset.denormalize(field, label)
+                    self.file[f'label/{key}'][lo - self.history:hi - self.history] = truth[i::len(keys)].numpy()
+                if self.metrics:
+                    error = (frames[i::len(keys)] - label[i::len(keys)]).flatten(1)
+                    for name, value in (('rmse', error.pow(2).mean(1).sqrt()), ('mae', error.abs().mean(1))):
+                        dset = self.file.require_dataset(f'metrics/{key}_{name}',
+                                                         shape=(self.num_frames - self.history,),
+                                                         dtype=np.float32)
+                        dset[lo - self.history:hi - self.history] = value.numpy()
+
+    def close(self):
+        r"""
+        Fill in what the simulation provides and close the file: the initial
+        history of the predicted fields and every frame of the other fields.
+        """
+        if self.file is None:
+            return
+        predicted = {key for field in self._written for key in FIELD_KEYS[field]}
+        with h5py.File(self.dataset.filename, 'r') as src:
+            for key, dset in src.items():
+                if not isinstance(dset, h5py.Dataset):
+                    continue
+                if dset.ndim == 3 and key not in predicted:
+                    self._copy(dset, key, self.num_frames)
+                elif dset.ndim == 3:
+                    self._copy(dset, key, self.history)
+                else:
+                    self.file.create_dataset(key, data=dset[()])
+        self.file.close()
+        self.file = None
+
+class RolloutMetrics:
+    r"""
+    Updates metrics.StreamingMetrics with every step of one rollout
+    trajectory, so the Metrics of arbitrarily long rollouts are computed
+    without keeping the predictions. It is passed to rollout.Rollout.run
+    like a RolloutWriter. The fields are the keys of the simulation file,
+    e.g. velx and vely for vel, and the interface is found from the sign
+    of dfun of the labels.
+
+    Args:
+        dataset (HDF5Dataset): The dataset of the trajectory.
+        start (int): The start timestep of the trajectory.
+        future_window (int): Number of frames predicted per step.
+        fields (list): The predicted fields, e.g. ['temp', 'vel']. None
+            uses every field of the predictions.
+    """
+    def __init__(self, dataset, start, future_window, fields=None):
+        self.dataset = dataset
+        self.start = start
+        self.future_window = future_window
+        self.fields = None
+        self.metrics = None
+        if fields is not None:
+            self._set_fields(fields)
+
+    def _set_fields(self, fields):
+        self.fields = list(fields)
+        self.metrics = StreamingMetrics([key for field in self.fields for key in FIELD_KEYS[field]])
+
+    def write(self, step, preds):
+        if self.fields is None:
+            self._set_fields(preds)
+        timestep = self.start + step * self.future_window
+        preds_by_key, labels_by_key = {}, {}
+        for field in self.fields:
+            keys = FIELD_KEYS[field]
+            frames = preds[field].detach().float()
+            label = self.dataset.get_window(field, timestep + self.dataset.time_window, self.future_window)
+            label = label.to(frames.device).float()
+            for i, key in enumerate(keys):
+                preds_by_key[key] = frames[i::len(keys)]
+                labels_by_key[key] = label[i::len(keys)]
+        # the sign of dfun of the label frames, as in get_dfun, without
+        # converting the whole simulation every step
+        first = self.dataset.time_window + timestep
+        dfun = self.dataset._data['dfun'][first:first + self.future_window].to(frames.device).float()
+        self.metrics.update(preds_by_key, labels_by_key, dfun, step * self.future_window)
+
+    def close(self):
+        pass
@@ -0,0 +1,79 @@
+r"""
+Node-local shared memory for simulation tensors.
+The first process on a node that asks for a tensor builds it and writes it
+to a file in shared memory (/dev/shm by default). Every other process, i.e.
+DataLoader workers and the other DDP ranks on the node, maps the same pages
+read-only. So, node RAM does not grow with the number of workers or ranks.
+"""
+import os
+import json
+import atexit
+import fcntl
+import hashlib
+import warnings
+from pathlib import Path
+import numpy as np
+import torch
+
+SHM_DIR = '/dev/shm'
+
+# files created by this process, removed when it exits. Processes that
+# already mapped them keep their pages, unlinking only drops the name.
+_created = []
+
+def _cleanup(pid):
+    if os.getpid() != pid:
+        return
+    for path in _created:
+        Path(path).unlink(missing_ok=True)
+
+def shared_key(*args):
+    r"""
+    Key identifying a group of shared tensors, e.g. (filename, mtime, steady_time)
+    """
+    return hashlib.sha1(':'.join(str(a) for a in args).encode()).hexdigest()[:16]
+
+def shared_tensor(shm_dir, key, name, build):
+    r"""
+    Get a read-only tensor backed by shared memory.
+
+    Args:
+        shm_dir (str): Directory in a shared memory filesystem. None uses /dev/shm.
+        key (str): Key of the group the tensor belongs to, see shared_key.
+        name (str): Name of the tensor in the group.
+        build (callable): Builds the tensor. Only called by the first process.
+    """
+    root = Path(shm_dir or SHM_DIR) / f'bubbleml-{os.getuid()}' / key
+    root.mkdir(parents=True, exist_ok=True)
+    path = root / f'{name}.bin'
+    meta_path = root / f'{name}.json'
+
+    # other processes wait for the builder, so the tensor is loaded once per node
+    with open(root / f'{name}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not meta_path.exists():
+            tensor = build()
+            # numpy has no bfloat16, so its bits are stored as int16
+            view = 'bfloat16' if tensor.dtype == torch.bfloat16 else None
+            array = (tensor.view(torch.int16) if view else tensor).numpy()
+            tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+            array.tofile(tmp_path)
+            os.replace(tmp_path, path)
+            meta_path.write_text(json.dumps({
+                'shape': list(array.shape),
+                'dtype': array.dtype.str,
+                'view': view,
+            }))
+            if not _created:
+                atexit.register(_cleanup, os.getpid())
+            _created.extend([path, meta_path])
+        meta = json.loads(meta_path.read_text())
+
+    array = np.memmap(path, dtype=np.dtype(meta['dtype']), mode='r', shape=tuple(meta['shape']))
+    with warnings.catch_warnings():
+        # the mapping is read-only on purpose, torch warns about that.
+        warnings.filterwarnings('ignore', message='The given NumPy array is not writable')
+        tensor = torch.from_numpy(array)
+    if meta.get('view'):
+        tensor = tensor.view(getattr(torch, meta['view']))
+    return tensor
@@ -0,0 +1,134 @@
+r"""
+Streaming statistics of the fields in a simulation file.
+The fields are reduced a chunk of frames at a time, so a pass never holds
+more than CHUNK_FRAMES frames in memory. Results are kept in a sidecar json
+file keyed by the file path, its mtime and steady_time, so only the first
+run over a simulation pays for the pass.
+"""
+import os
+import json
+import hashlib
+from pathlib import Path
+import h5py
+import numpy as np
+
+CHUNK_FRAMES = 32
+HIST_BINS = 64
+
+class StreamingStats:
+    r"""
+    Running count, min, max, mean and variance of the chunks passed to update.
+    Chunks are merged with Chan et al.'s pairwise update, so the variance
+    stays accurate over long simulations.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        n = chunk.size
+        if n == 0:
+            return
+        mean = chunk.mean()
+        m2 = np.square(chunk - mean).sum()
+        delta = mean - self.mean
+        total = self.count + n
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.count * n / total
+        self.count = total
+        self.min = min(self.min, chunk.min())
+        self.max = max(self.max, chunk.max())
+
+    def result(self):
+        return {
+            'count': int(self.count),
+            'min': float(self.min),
+            'max': float(self.max),
+            'absmax': float(max(abs(self.min), abs(self.max))),
+            'mean': float(self.mean),
+            'std': float(np.sqrt(self.m2 / self.count)) if self.count else 0.0,
+        }
+
+def reduce_field(dset, steady_time, chunk_frames=CHUNK_FRAMES, bins=HIST_BINS):
+    r"""
+    Statistics of frames steady_time onward of an hdf5 dataset [T x H x W].
+    NaNs are treated as zeros, as the datasets do when they read them.
+    The histogram needs the range, so it takes a second pass.
+    """
+    num_frames = dset.shape[0]
+    starts = range(steady_time, num_frames, chunk_frames)
+    running = StreamingStats()
+    for start in starts:
+        running.update(np.nan_to_num(dset[start:start + chunk_frames]))
+    stats = running.result()
+
+    hist = np.zeros(bins, dtype=np.int64)
+    # a constant field still gets a valid range
+    high = stats['max'] if stats['max'] > stats['min'] else stats['min'] + 1
+    bin_edges = np.linspace(stats['min'], high, bins + 1)
+    for start in starts:
+        chunk = np.nan_to_num(dset[start:start + chunk_frames])
+        hist += np.histogram(chunk, bins=bin_edges)[0]
+    stats['hist'] = hist.tolist()
+    stats['bin_edges'] = bin_edges.tolist()
+    return stats
+
+def _cache_path(filename, cache_dir):
+    resolved = Path(filename).resolve()
+    digest = hashlib.sha1(str(resolved).encode()).hexdigest()[:16]
+    parent = Path(cache_dir) if cache_dir is not None else resolved.parent
+    return parent / f'{resolved.stem}_stats_{digest}.json'
+
+def _load_cache(cache_path, mtime):
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get('mtime') != mtime:
+        # the simulation changed since the stats were computed
+        return {}
+    return cache.get('steady_time', {})
+
+def _write_cache(cache_path, filename, mtime, entries):
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # merge with entries written by other processes in the meantime
+        merged = _load_cache(cache_path, mtime)
+        for steady_time, stats in entries.items():
+            merged.setdefault(steady_time, {}).update(stats)
+        # write then rename, so concurrent ranks never see a partial file
+        tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'path': str(Path(filename).resolve()), 'mtime': mtime, 'steady_time': merged}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f'could not write stats cache {cache_path}: {e}')
+
+def field_stats(filename, keys, steady_time, cache_dir=None):
+    r"""
+    Statistics (count, min, max, absmax, mean, std and a histogram) of
+    frames steady_time onward of each field in keys.
+
+    Args:
+        filename (str): Path of the hdf5 simulation.
+        keys (list): Names of the fields in the file, e.g. ['velx', 'vely'].
+        steady_time (int): The first frame used.
+        cache_dir (str): Directory of the sidecar cache. None puts it next
+            to the simulation. If it cannot be written, the stats are
+            computed on every call.
+    """
+    mtime = os.path.getmtime(filename)
+    cache_path = _cache_path(filename, cache_dir)
+    cached = _load_cache(cache_path, mtime).get(str(steady_time), {})
+    missing = [key for key in keys if key not in cached]
+    if missing:
+        with h5py.File(filename, 'r') as f:
+            computed = {key: reduce_field(f[key], steady_time) for key in missing}
+        _write_cache(cache_path, filename, mtime, {str(steady_time): computed})
+        cached = {**cached, **computed}
+    return {key: cached[key] for key in keys}
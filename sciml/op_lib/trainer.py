@@ -0,0 +1,300 @@
+import contextlib
+import math
+import torch
+import numpy as np
+import time
+from pathlib import Path
+
+from .metrics import StreamingMetrics
+from .metric_logger import AsyncScalarWriter, MetricAccumulator
+from .instrument import Instrumentation
+from .rollout import Rollout
+from .rollout_writer import RolloutWriter, RolloutMetrics
+from .dist_utils import dist_is_used, gather_to_leader, is_leader_process, rank, world_size
+
+# experiment.train.precision -> autocast dtype
+PRECISIONS = {
+    'fp32': None,
+    'bf16': torch.bfloat16,
+}
+
+class Trainer:
+    r"""
+    The train, val and checkpoint loops shared by the trainers. A trainer
+    plugs in its field-specific parts:
+      - _forward_int(...), which runs the model through self._model_forward,
+      - train_loss(batch, push_forward_steps) and val_loss(batch), which
+        return the loss and a dict of tensorboard tag -> (pred, label),
+      - _rollout_history, _rollout_step and optionally _rollout_feedback,
+        used by rollout, see rollout.Rollout,
+      - test(dataset), which evaluates a rollout of the val set.
+    These options of experiment.train set how the model is run:
+      - precision: fp32 or bf16. bf16 runs the forward pass under autocast,
+        on the GPU or the CPU. Losses are computed in fp32.
+      - compile: a torch.compile mode, e.g. default or max-autotune.
+        None or False runs the model eagerly.
+      - accumulation_steps: number of batches whose gradients are summed
+        before an optimizer step. The lr schedule steps with the optimizer.
+      - channels_last: run the model on channels-last inputs.
+      - log_interval: number of iterations whose losses and metrics are
+        aggregated on the device before they are written, see
+        metric_logger.MetricAccumulator. Timings of the train loop are
+        written at the same interval, see instrument.Instrumentation.
+      - instrument_sync: synchronize the device at the end of each timed
+        range, so the timings include the device time.
+      - profile: a torch.profiler trace window (wait, warmup, active,
+        repeat and dir). None disables tracing.
+    """
+    def __init__(self,
+                 model,
+                 future_window,
+                 max_push_forward_steps,
+                 train_dataloader,
+                 val_dataloader,
+                 optimizer,
+                 lr_scheduler,
+                 val_variable,
+                 writer,
+                 cfg):
+        self.model = model
+        self.train_dataloader = train_dataloader
+        self.val_dataloader = val_dataloader
+        self.optimizer = optimizer
+        self.lr_scheduler = lr_scheduler
+        self.val_variable = val_variable
+        self.writer = writer
+        self.cfg = cfg
+
+        self.max_push_forward_steps = max_push_forward_steps
+        self.future_window = future_window
+        self.use_coords = cfg.train.use_coords
+        self.device = next(model.parameters()).device
+
+        precision = cfg.train.get('precision', 'fp32')
+        assert precision in PRECISIONS, f'unknown precision {precision}'
+        self.amp_dtype = PRECISIONS[precision]
+        self.accumulation_steps = cfg.train.get('accumulation_steps', 1)
+        assert self.accumulation_steps > 0
+        self.channels_last = cfg.train.get('channels_last', False)
+        if self.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        # the compiled model shares its parameters with self.model,
+        # so checkpoints are still saved from self.model
+        compile_mode = cfg.train.get('compile', None)
+        self.forward_model = torch.compile(self.model, mode=compile_mode) if compile_mode else self.model
+        self.log_interval = cfg.train.get('log_interval', 1)
+        self.scalar_writer = AsyncScalarWriter(writer)
+        self.perf = Instrumentation(self.scalar_writer,
+                                    self.log_interval,
+                                    sync=cfg.train.get('instrument_sync', False),
+                                    profile=cfg.train.get('profile', None),
+                                    log_dir=getattr(writer, 'log_dir', '.'))
+
+    def save_checkpoint(self, log_dir, dataset_name):
+        timestamp = int(time.time())
+        if self.cfg.distributed:
+            model_name = self.model.module.__class__.__name__
+        else:
+            model_name = self.model.__class__.__name__
+        ckpt_file = f'{model_name}_{self.cfg.torch_dataset_name}_{self.cfg.train.max_epochs}_{timestamp}.pt'
+        ckpt_root = Path.home() / f'{log_dir}/{dataset_name}'
+        Path(ckpt_root).mkdir(parents=True, exist_ok=True)
+        ckpt_path = f'{ckpt_root}/{ckpt_file}'
+        print(f'saving model to {ckpt_path}')
+        if self.cfg.distributed:
+            torch.save(self.model.module.state_dict(), f'{ckpt_path}')
+        else:
+            torch.save(self.model.state_dict(), f'{ckpt_path}')
+
+    def push_forward_prob(self, epoch, max_epochs):
+        r"""
+        Randomly set the number of push-forward steps based on current
+        iteration. Initially, it's unlike to "push-forward." later in training,
+        it's nearly certain to apply the push-forward trick.
+        """
+        cur_iter = epoch * len(self.train_dataloader)
+        tot_iter = max_epochs * len(self.train_dataloader)
+        frac = cur_iter / tot_iter
+        if np.random.uniform() > frac:
+            return 1
+        else:
+            return self.max_push_forward_steps
+
+    def train(self, max_epochs, log_dir, dataset_name):
+        self.perf.start_profiler()
+        for epoch in range(max_epochs):
+            print('epoch ', epoch)
+            if hasattr(self.train_dataloader.sampler, 'set_epoch'):
+                self.train_dataloader.sampler.set_epoch(epoch)
+            self.train_step(epoch, max_epochs)
+            self.val_step(epoch)
+            self.scalar_writer.flush()
+            if dist_is_used():
+                # every rank takes part, each rolls out its share of the simulations
+                self.evaluate(self.val_dataloader.dataset.datasets)
+            elif is_leader_process():
+                val_dataset = self.val_dataloader.dataset.datasets[0]
+                self.test(val_dataset)
+            if is_leader_process():
+                with self.perf.range('checkpoint'):
+                    self.save_checkpoint(log_dir, dataset_name)
+                self.perf.write_range('checkpoint', (epoch + 1) * len(self.train_dataloader) - 1)
+        self.perf.close()
+
+    def _to_device(self, batch):
+        return [t.to(self.device, non_blocking=True).float() for t in batch]
+
+    def _model_forward(self, input):
+        r"""
+        Run the model with the precision, compile and memory format options.
+        Predictions are returned in fp32.
+        """
+        if self.channels_last:
+            input = input.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(device_type=self.device.type,
+                            dtype=self.amp_dtype,
+                            enabled=self.amp_dtype is not None):
+            pred = self.forward_model(input)
+        return pred.float().contiguous()
+
+    def train_loss(self, batch, push_forward_steps):
+        raise NotImplementedError
+
+    def val_loss(self, batch):
+        raise NotImplementedError
+
+    def train_step(self, epoch, max_epochs):
+        self.model.train()
+        self.optimizer.zero_grad()
+        num_iters = len(self.train_dataloader)
+        log = MetricAccumulator(self.scalar_writer, 'train', self.log_interval)
+        perf = self.perf
+        perf.reset()
+        for iter, batch in enumerate(perf.iterate(self.train_dataloader)):
+            with perf.range('h2d'):
+                batch = self._to_device(batch)
+            push_forward_steps = self.push_forward_prob(epoch, max_epochs)
+            step = (iter + 1) % self.accumulation_steps == 0 or iter + 1 == num_iters
+            # DDP only needs to all-reduce the gradients before a step
+            sync = contextlib.nullcontext() if step or not hasattr(self.model, 'no_sync') else self.model.no_sync()
+            with sync:
+                with perf.range('forward'):
+                    loss, metrics = self.train_loss(batch, push_forward_steps)
+                with perf.range('backward'):
+                    (loss / self.accumulation_steps).backward()
+            if step:
+                with perf.range('optimizer'):
+                    self.optimizer.step()
+                    self.lr_scheduler.step()
+                    self.optimizer.zero_grad()
+
+            global_iter = epoch * num_iters + iter
+            with perf.range('metrics'):
+                log.update(loss, metrics, global_iter)
+            perf.step(global_iter, batch[0].size(0))
+            del batch, loss, metrics
+        log.flush()
+        perf.flush()
+
+    def val_step(self, epoch):
+        self.model.eval()
+        # the val set is sharded over the ranks, so its metrics are all-reduced
+        log = MetricAccumulator(self.scalar_writer, 'val', self.log_interval, reduce=dist_is_used())
+        for iter, batch in enumerate(self.val_dataloader):
+            batch = self._to_device(batch)
+            with torch.no_grad():
+                loss, metrics = self.val_loss(batch)
+            global_iter = epoch * len(self.val_dataloader) + iter
+            log.update(loss, metrics, global_iter)
+            del batch, loss, metrics
+        log.flush()
+
+    def _rollout_history(self, sample):
+        raise NotImplementedError
+
+    def _rollout_step(self, inputs, history):
+        raise NotImplementedError
+
+    def _rollout_feedback(self, field, pred):
+        return pred
+
+    def rollout(self, datasets, starts, num_steps, writers=None):
+        r"""
+        Roll out a batch of trajectories, one per (dataset, start timestep).
+        Returns the predictions (on the device) and labels (on the host) of
+        each predicted field, [N x num_steps * C x H x W], or streams the
+        predictions to writers, see rollout.Rollout.run
+        """
+        self.model.eval()
+        engine = Rollout(self._rollout_history,
+                         self._rollout_step,
+                         self.future_window,
+                         self.device,
+                         self._rollout_feedback)
+        return engine.run(datasets, starts, num_steps, writers)
+
+    def write_rollout(self, datasets, paths, num_steps, starts=None, **kwargs):
+        r"""
+        Roll out each dataset (from starts, by default 0) and stream the
+        predictions into the hdf5 file of paths with the same index, see
+        rollout_writer.RolloutWriter, which also takes the kwargs.
+        """
+        starts = starts if starts is not None else [0] * len(datasets)
+        writers = [RolloutWriter(path, dataset, start, num_steps, self.future_window, **kwargs)
+                   for dataset, start, path in zip(datasets, starts, paths)]
+        try:
+            self.rollout(datasets, starts, num_steps, writers)
+        finally:
+            for writer in writers:
+                writer.close()
+
+    def rollout_metrics(self, datasets, num_steps, fields=None, starts=None):
+        r"""
+        Roll out each dataset (from starts, by default 0) and compute the
+        Metrics of the fields (by default, every predicted field) with
+        streaming accumulators, so memory does not grow with num_steps.
+        Returns a metrics.StreamingMetrics per trajectory; compute() gives
+        key -> Metrics and frame_rmse() the per-timestep RMSE.
+        """
+        starts = starts if starts is not None else [0] * len(datasets)
+        writers = [RolloutMetrics(dataset, start, self.future_window, fields)
+                   for dataset, start in zip(datasets, starts)]
+        self.rollout(datasets, starts, num_steps, writers)
+        return [writer.metrics for writer in writers]
+
+    def evaluate(self, datasets, max_time_limit=200):
+        r"""
+        Metrics of a rollout of every dataset (e.g. every val simulation)
+        from timestep 0, of up to max_time_limit frames as in test. The
+        datasets are sharded over the ranks: each rank rolls out its
+        datasets at once with rollout_metrics, and the leader gathers the
+        accumulators. Every rank must call it. Returns, on the leader, a
+        dict key -> Metrics for each dataset, in order. None on the other
+        ranks.
+        """
+        self.model.eval()
+        groups = {}
+        for i in range(rank(), len(datasets), world_size()):
+            time_limit = min(max_time_limit, len(datasets[i]))
+            groups.setdefault(math.ceil(time_limit / self.future_window), []).append(i)
+        states = {}
+        for num_steps, idx in groups.items():
+            metrics = self.rollout_metrics([datasets[i] for i in idx], num_steps)
+            states.update({i: m.state_dict() for i, m in zip(idx, metrics)})
+
+        gathered = gather_to_leader(states)
+        if gathered is None:
+            return None
+        states = {i: state for part in gathered for i, state in part.items()}
+        results = []
+        for i in range(len(datasets)):
+            metrics = StreamingMetrics(states[i]['fields'])
+            metrics.merge(states[i])
+            results.append(metrics.compute())
+            for key, value in results[-1].items():
+                print(f'{datasets[i].filename} {key.upper()} METRICS')
+                print(value)
+        return results
+
+    def test(self, dataset):
+        raise NotImplementedError
@@ -2,96 +2,31 @@ import torch
 from torch import nn
 import torchvision
 import torch.nn.functional as F
-from torch.optim.lr_scheduler import ReduceLROnPlateau, PolynomialLR
 from torch.utils.data import ConcatDataset, DataLoader
 from torch.utils.tensorboard import SummaryWriter
 import torchvision.transforms.functional as TF
 import matplotlib.pyplot as plt
 import numpy as np
-import time
-from pathlib import Path
+import math
 
-from .hdf5_dataset import HDF5Dataset, VelDfunDataset
-from .metrics import compute_metrics, write_metrics
+from .hdf5_dataset import HDF5Dataset, VelDfunDataset, expand_vapor_mask
+from .metrics import compute_field_metrics
 from .losses import LpLoss
 from .plt_util import plt_temp, plt_iter_mae, plt_vel
 from .heatflux import heatflux
-from .dist_utils import local_rank, is_leader_process
-from .downsample import downsample_domain
+from .trainer import Trainer
 
-from torch.cuda import nvtx 
 
 t_bulk_map = {
     'wall_super_heat': 58,
     'subcooled': 50
 }
 
-class VelDfunTrainer:
-    def __init__(self,
-                 model,
-                 future_window,
-                 max_push_forward_steps,
-                 train_dataloader,
-                 val_dataloader,
-                 optimizer,
-                 lr_scheduler,
-                 val_variable,
-                 writer,
-                 cfg):
-        self.model = model
-        self.train_dataloader = train_dataloader
-        self.val_dataloader = val_dataloader
-        self.optimizer = optimizer
-        self.lr_scheduler = lr_scheduler
-        self.val_variable = val_variable
-        self.writer = writer
-        self.cfg = cfg
+class VelDfunTrainer(Trainer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         self.loss = LpLoss(d=2, reduce_dims=[0, 1])
 
-        self.max_push_forward_steps = max_push_forward_steps
-        self.future_window = future_window
-        self.use_coords = cfg.train.use_coords
-
-    def save_checkpoint(self, log_dir, dataset_name):
-        timestamp = int(time.time())
-        if self.cfg.distributed:
-            model_name = self.model.module.__class__.__name__
-        else:
-            model_name = self.model.__class__.__name__
-        ckpt_file = f'{model_name}_{self.cfg.torch_dataset_name}_{self.cfg.train.max_epochs}_{timestamp}.pt'
-        ckpt_root = Path.home() / f'{log_dir}/{dataset_name}'
-        Path(ckpt_root).mkdir(parents=True, exist_ok=True)
-        ckpt_path = f'{ckpt_root}/{ckpt_file}'
-        print(f'saving model to {ckpt_path}')
-        if self.cfg.distributed:
-            torch.save(self.model.module.state_dict(), f'{ckpt_path}')
-        else:
-            torch.save(self.model.state_dict(), f'{ckpt_path}')
-
-    def push_forward_prob(self, epoch, max_epochs):
-        r"""
-        Randomly set the number of push-forward steps based on current
-        iteration. Initially, it's unlike to "push-forward." later in training,
-        it's nearly certain to apply the push-forward trick.
-        """
-        cur_iter = epoch * len(self.train_dataloader)
-        tot_iter = max_epochs * len(self.train_dataloader)
-        frac = cur_iter / tot_iter
-        if np.random.uniform() > frac:
-            return 1
-        else:
-            return self.max_push_forward_steps
-
-    def train(self, max_epochs, log_dir, dataset_name):
-        for epoch in range(max_epochs):
-            print('epoch ', epoch)
-            self.train_step(epoch, max_epochs)
-            self.val_step(epoch)
-            if is_leader_process():
-                val_dataset = self.val_dataloader.dataset.datasets[0]
-                self.test(val_dataset)
-                self.save_checkpoint(log_dir, dataset_name)
-
     def _forward_int(self, nucleation_layer, vel, dfun):
         # TODO: account for possibly different timestep sizes of training data
         # Print the shapes of the tensors
@@ -102,7 +37,7 @@ class VelDfunTrainer:
         # print("nucleation_layer shape:", nucleation_layer.shape)
         input = torch.cat((vel, dfun,nucleation_layer), dim=1)
         # print("input shape:", input.shape)
-        pred = self.model(input)
+        pred = self._model_forward(input)
 
         #timesteps = (torch.arange(self.future_window) + 1).cuda().unsqueeze(-1).unsqueeze(-1).float()
         #timesteps /= 10 # timestep size is 0.1 for vel
@@ -143,133 +78,83 @@ class VelDfunTrainer:
         #print("Actual size of vel_input:", vel_input.size(1))
         
         assert self.future_window*2 == vel_input.size(1), 'push-forward expects history size to match future'
-        nucleation_layer_input, vel_input, dfun_input = \
-                downsample_domain(self.cfg.train.downsample_factor, nucleation_layer_input, vel_input, dfun_input)
         with torch.no_grad():
             for idx in range(push_forward_steps - 1):
                 vel_input = self._forward_int(nucleation_layer_input, vel_input, dfun_input)
                 dfun_input = self._index_dfun(idx + 1, dfun)
-                dfun_input = downsample_domain(self.cfg.train.downsample_factor, dfun_input)[0]
         if self.cfg.train.noise and push_forward_steps == 1:
             vel_input += torch.empty_like(vel_input).normal_(0, 0.01)
         vel_pred, dfun_pred = self._forward_int(nucleation_layer_input, vel_input, dfun_input)
         return  vel_pred, dfun_pred
 
-    def train_step(self, epoch, max_epochs):
-        self.model.train()
-
-        # warmup before doing push forward trick
-        for iter, (vel, dfun, nucleation_layer, vel_label, dfun_label) in enumerate(self.train_dataloader):
-            
-            vel = vel.to(local_rank()).float()
-            dfun = dfun.to(local_rank()).float()
-            nucleation_layer = nucleation_layer.to(local_rank()).float()
-            push_forward_steps = self.push_forward_prob(epoch, max_epochs)
-            
-            vel_pred,dfun_pred = self.push_forward_trick(nucleation_layer, vel, dfun, push_forward_steps)
-
-            
-            idx = (push_forward_steps - 1)
-            vel_label = vel_label[:, idx].to(local_rank()).float()
-            idx = (push_forward_steps - 1)
-            dfun_label = dfun_label[:, idx].to(local_rank()).float()
-            # print("Shape1 of vel_label:", vel_label.shape)
-            # print("Shape1 of vel_pred:", vel_pred.shape)
-            # print("Shape1 of dfun_label:", dfun_label.shape)
-            # print("Shape1 of dfun_pred:", dfun_pred.shape)
-            vel_label = downsample_domain(self.cfg.train.downsample_factor, vel_label)[0]
-            dfun_label = downsample_domain(self.cfg.train.downsample_factor, dfun_label)[0]
-           
-
-            vel_loss = F.mse_loss(vel_pred, vel_label)
-            dfun_loss = F.mse_loss(dfun_pred, dfun_label)
-            loss = (vel_loss + dfun_loss) /2 
-            self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
-            self.lr_scheduler.step()
-            
-            print(f'train loss(vel): {loss}')
-            global_iter = epoch * len(self.train_dataloader) + iter
-            write_metrics(vel_pred, vel_label, global_iter, 'TrainVel', self.writer)
-            write_metrics(dfun_pred, dfun_label, global_iter, 'TrainDfun', self.writer)
-            del vel, dfun, vel_label, dfun_label
-
-    def val_step(self, epoch):
-        self.model.eval()
-        for iter, (vel, dfun, nucleation_layer, vel_label, dfun_label) in enumerate(self.val_dataloader):
-            
-            vel = vel.to(local_rank()).float()
-            dfun = dfun.to(local_rank()).float()
-            nucleation_layer = nucleation_layer.to(local_rank()).float()
-            # val doesn't apply push-forward
-            vel_label = vel_label[:, 0].to(local_rank()).float()
-            dfun_label = dfun_label[:, 0].to(local_rank()).float()
-
-            with torch.no_grad():
-                vel_pred,dfun_pred = self._forward_int(nucleation_layer[:, 0],vel[:, 0], dfun[:, 0])
-                vel_loss = F.mse_loss(vel_pred, vel_label)
-                dfun_loss = F.mse_loss(dfun_pred, dfun_label)
-                #loss = (vel_loss+dfun_loss)/2
-            print(f'val loss: {vel_loss}')
-            print(f'dfun loss: {dfun_loss}')
-            global_iter = epoch * len(self.val_dataloader) + iter
-            write_metrics(vel_pred, vel_label, global_iter, 'ValVel', self.writer)
-            write_metrics(dfun_pred, dfun_label, global_iter, 'ValDfun', self.writer)
-            del vel, dfun, vel_label, dfun_label
+    def train_loss(self, batch, push_forward_steps):
+        vel, dfun, nucleation_layer, vel_label, dfun_label = batch
+        vel_pred,dfun_pred = self.push_forward_trick(nucleation_layer, vel, dfun, push_forward_steps)
+
+        idx = (push_forward_steps - 1)
+        vel_label = vel_label[:, idx]
+        dfun_label = dfun_label[:, idx]
+        # print("Shape1 of vel_label:", vel_label.shape)
+        # print("Shape1 of vel_pred:", vel_pred.shape)
+        # print("Shape1 of dfun_label:", dfun_label.shape)
+        # print("Shape1 of dfun_pred:", dfun_pred.shape)
+
+        vel_loss = F.mse_loss(vel_pred, vel_label)
+        dfun_loss = F.mse_loss(dfun_pred, dfun_label)
+        loss = (vel_loss + dfun_loss) /2 
+        return loss, {'TrainVel': (vel_pred, vel_label), 'TrainDfun': (dfun_pred, dfun_label)}
+
+    def val_loss(self, batch):
+        vel, dfun, nucleation_layer, vel_label, dfun_label = batch
+        # val doesn't apply push-forward
+        vel_label = vel_label[:, 0]
+        dfun_label = dfun_label[:, 0]
+        vel_pred,dfun_pred = self._forward_int(nucleation_layer[:, 0],vel[:, 0], dfun[:, 0])
+        vel_loss = F.mse_loss(vel_pred, vel_label)
+        # the dfun error is logged with the ValDfun metrics
+        return vel_loss, {'ValVel': (vel_pred, vel_label), 'ValDfun': (dfun_pred, dfun_label)}
+
+    def _rollout_history(self, sample):
+        vel, dfun, nucleation_layer, vel_label, dfun_label = sample
+        return {'vel': vel[:, 0], 'dfun': dfun[:, 0]}
+
+    def _rollout_step(self, inputs, history):
+        nucleation_layer, = inputs
+        # val doesn't apply push-forward
+        vel_pred,dfun_pred = self._forward_int(nucleation_layer, history['vel'], history['dfun'])
+        return {'vel': vel_pred, 'dfun': dfun_pred}
+
+    def _rollout_feedback(self, field, pred):
+        if field == 'dfun':
+            # the dataset keeps the sign of predicted dfun, which is read back as a vapor mask
+            return expand_vapor_mask(torch.sign(pred).to(torch.int8))
+        return pred
 
     def test(self, dataset, max_time_limit=200):
-        self.model.eval()
-        vels = []
-        vels_labels = []
-        dfuns = []
-        dfuns_labels = []
         time_limit = min(max_time_limit, len(dataset))
-        for timestep in range(0, time_limit, self.future_window):
-            vel, dfun, nucleation_layer, vel_label, dfun_label = dataset[timestep]
-            
-            
-            vel = vel.to(local_rank()).float().unsqueeze(0)
-            dfun = dfun.to(local_rank()).float().unsqueeze(0)
-            nucleation_layer = nucleation_layer.to(local_rank()).float().unsqueeze(0)
-            # val doesn't apply push-forward
-            vel_label = vel_label[0].to(local_rank()).float()
-            dfun_label = dfun_label[0].to(local_rank()).float()
-            with torch.no_grad():
-                vel_pred,dfun_pred = self._forward_int(nucleation_layer[:, 0],vel[:, 0], dfun[:, 0])
-                vel_pred = vel_pred.squeeze(0)
-                dfun_pred = dfun_pred.squeeze(0)
-                dataset.write_vel(vel_pred, timestep)
-                dataset.write_dfun(dfun_pred, timestep)
-                vels.append(vel_pred.detach().cpu())
-                vels_labels.append(vel_label.detach().cpu())
-                dfuns.append(dfun_pred.detach().cpu())
-                dfuns_labels.append(dfun_label.detach().cpu())
+        num_steps = math.ceil(time_limit / self.future_window)
+        preds, labels = self.rollout([dataset], [0], num_steps)
         # a little bit unsure about the last dfun.
-        vels = torch.cat(vels, dim=0)
-        vels_labels = torch.cat(vels_labels, dim=0)
-        dfuns = torch.cat(dfuns, dim=0)
-        dfuns_labels = torch.cat(dfuns_labels, dim=0)
+        vels = preds['vel'][0].cpu()
+        vels_labels = labels['vel'][0].cpu()
+        dfuns = preds['dfun'][0].cpu()
+        dfuns_labels = labels['dfun'][0].cpu()
         dfun = dataset.get_dfun()[:vels.size(0)//2]
 
-
-        print(vels.size(), vels_labels.size(), dfun.size())
-        print(dfuns.size(), dfuns_labels.size(), dfun.size())
-
         velx_preds = vels[0::2]
         velx_labels = vels_labels[0::2]
         vely_preds = vels[1::2]
         vely_labels = vels_labels[1::2]
 
-        metrics = compute_metrics(velx_preds, velx_labels, dfun)
+        metrics = compute_field_metrics({'velx': velx_preds, 'vely': vely_preds, 'dfun': dfuns},
+                                        {'velx': velx_labels, 'vely': vely_labels, 'dfun': dfuns_labels},
+                                        dfun)
         print('VELX METRICS')
-        print(metrics)
-        metrics = compute_metrics(vely_preds, vely_labels, dfun)
+        print(metrics['velx'])
         print('VELY METRICS')
-        print(metrics)
-        metrics = compute_metrics(dfuns, dfuns_labels, dfun)
+        print(metrics['vely'])
         print('DFUN METRICS')
-        print(metrics)
+        print(metrics['dfun'])
         
         #xgrid = dataset.get_x().permute((2, 0, 1))
         #print(heatflux(temps, dfun, self.val_variable, xgrid, dataset.get_dy()))
@@ -288,5 +173,3 @@ class VelDfunTrainer:
                 vely_preds, vely_labels,
                 dfuns, dfuns_labels,
                 model_name)
-
-        dataset.reset()
\ No newline at end of file
@@ -2,21 +2,19 @@ import torch
 from torch import nn
 import torchvision
 import torch.nn.functional as F
-from torch.optim.lr_scheduler import ReduceLROnPlateau, PolynomialLR
 from torch.utils.data import ConcatDataset, DataLoader
 from torch.utils.tensorboard import SummaryWriter
 import torchvision.transforms.functional as TF
 import matplotlib.pyplot as plt
 import numpy as np
-import time
-from pathlib import Path
 
 from .hdf5_dataset import HDF5Dataset, TempVelDataset
 from .metrics import compute_metrics
 from .losses import LpLoss
 from .plt_util import plt_temp, plt_vel
+from .trainer import Trainer
 
-class VelTrainer:
+class VelTrainer(Trainer):
     def __init__(self,
                  model,
                  train_dataloader,
@@ -26,74 +24,28 @@ class VelTrainer:
                  val_variable,
                  writer,
                  cfg):
-        self.model = model
-        self.train_dataloader = train_dataloader
-        self.val_dataloader = val_dataloader
-        self.optimizer = optimizer
-        self.lr_scheduler = lr_scheduler
-        self.val_variable = val_variable
-        self.writer = writer
-        self.cfg = cfg
+        super().__init__(model, 1, 1, train_dataloader, val_dataloader, optimizer, lr_scheduler, val_variable, writer, cfg)
         self.loss = LpLoss(d=2)
 
-    def save_checkpoint(self, dataset_name):
-        timestamp = int(time.time())
-        if self.cfg.distributed:
-            model_name = self.model.module.__class__.__name__
-        else:
-            model_name = self.model.__class__.__name__
-        ckpt_file = f'{model_name}_{cfg.torch_dataset_name}_{cfg.train.max_epochs}_{timestamp}.pt'
-        ckpt_root = Path.home() / f'{log_dir}/{dataset_name}'
-        Path(ckpt_root).mkdir(parents=True, exist_ok=True)
-        ckpt_path = f'{ckpt_root}/{ckpt_file}'
-        print(f'saving model to {ckpt_path}')
-        if cfg.distributed:
-            torch.save(self.model.module.state_dict(), f'{ckpt_path}')
-        else:
-            torch.save(self.model.state_dict(), f'{ckpt_path}')
+    def train_loss(self, batch, push_forward_steps):
+        input, label = batch
+        pred = self._model_forward(input)
+        temp_loss = self.loss(pred[:, 0], label[:, 0])
+        velx_loss = self.loss(pred[:, 1], label[:, 1])
+        vely_loss = self.loss(pred[:, 2], label[:, 2])
+        print(f'{temp_loss}, {velx_loss}, {vely_loss}')
+        loss = (temp_loss + velx_loss + vely_loss) / 3
+        return loss, {}
 
-    def train(self, max_epochs, dataset_name):
-        for epoch in range(max_epochs):
-            print('epoch ', epoch)
-            self.train_step(epoch)
-            self.val_step(epoch)
-            self.lr_scheduler.step()
-            val_dataset = self.val_dataloader.dataset.datasets[0]
-            self.test(val_dataset)
-            self.save_checkpoint(dataset_name)
-
-    def train_step(self, epoch):
-        self.model.train()
-        for iter, (input, label) in enumerate(self.train_dataloader):
-            input = input.cuda().float()
-            label = label.cuda().float()
-            pred = self.model(input)
-            print(pred.size(), label.size())
-            temp_loss = self.loss(pred[:, 0], label[:, 0])
-            velx_loss = self.loss(pred[:, 1], label[:, 1])
-            vely_loss = self.loss(pred[:, 2], label[:, 2])
-            print(f'{temp_loss}, {velx_loss}, {vely_loss}')
-            loss = (temp_loss + velx_loss + vely_loss) / 3
-            self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
-            print(f'train loss: {loss}')
-            del input, label
-
-    def val_step(self, epoch):
-        self.model.eval()
-        for iter, (input, label) in enumerate(self.val_dataloader):
-            input = input.cuda().float()
-            label = label.cuda().float()
-            with torch.no_grad():
-                pred = self.model(input)
-                temp_loss = F.mse_loss(pred[:, 0], label[:, 0])
-                velx_loss = F.mse_loss(pred[:, 1], label[:, 1])
-                vely_loss = F.mse_loss(pred[:, 2], label[:, 2])
-                print(f'{temp_loss}, {velx_loss}, {vely_loss}')
-                loss = (temp_loss + velx_loss + vely_loss) / 3
-            print(f'val loss: {loss}')
-            del input, label
+    def val_loss(self, batch):
+        input, label = batch
+        pred = self._model_forward(input)
+        temp_loss = F.mse_loss(pred[:, 0], label[:, 0])
+        velx_loss = F.mse_loss(pred[:, 1], label[:, 1])
+        vely_loss = F.mse_loss(pred[:, 2], label[:, 2])
+        print(f'{temp_loss}, {velx_loss}, {vely_loss}')
+        loss = (temp_loss + velx_loss + vely_loss) / 3
+        return loss, {}
 
     def test(self, dataset):
         self.model.eval()
@@ -105,11 +57,11 @@ class VelTrainer:
         vely_labels = []
         for timestep in range(len(dataset)):
             input, label = dataset[timestep]
-            input = input.cuda().float().unsqueeze(0)
-            label = label.cuda().float().unsqueeze(0)
+            input = input.to(self.device).float().unsqueeze(0)
+            label = label.to(self.device).float().unsqueeze(0)
             print(input.size(), label.size())
             with torch.no_grad():
-                pred = self.model(input)
+                pred = self._model_forward(input)
                 temp = pred[:, 0]
                 velx = F.hardtanh(pred[:, 1], min_val=-1, max_val=1)
                 vely = F.hardtanh(pred[:, 2], min_val=-1, max_val=1)
@@ -13,11 +13,13 @@ from pathlib import Path
 import os
 import time
 import math
+from functools import partial
 
 from torch.utils.data.distributed import DistributedSampler
 from torch.nn.parallel import DistributedDataParallel as DDP
 
 from op_lib.disk_hdf5_dataset import (
+        worker_init_fn,
         DiskTempInputDataset,
         DiskTempVelDataset,
         DiskVelInputDataset,
@@ -25,6 +27,7 @@ from op_lib.disk_hdf5_dataset import (
         DiskVelDfunDataset
 )
 from op_lib.hdf5_dataset import (
+        collate,
         HDF5ConcatDataset,
         TempInputDataset,
         TempVelDataset,
@@ -32,6 +35,13 @@ from op_lib.hdf5_dataset import (
         VelCoordInputDataset,
         VelDfunDataset
 )
+from op_lib.mmap_dataset import (
+        MmapTempInputDataset,
+        MmapTempVelDataset,
+        MmapVelInputDataset,
+        MmapVelCoordInputDataset,
+        MmapVelDfunDataset
+)
 
 from op_lib.temp_trainer import TempTrainer
 from op_lib.vel_trainer import VelTrainer
@@ -40,17 +50,21 @@ from op_lib.vel_only_trainer import VelOnlyTrainer
 from op_lib.vel_coord_trainer import VelCoordTrainer
 from op_lib.vel_dfun_trainer import VelDfunTrainer
 from op_lib.schedule_utils import LinearWarmupLR
+from op_lib.block_sampler import BlockShuffleSampler
+from op_lib.device_loader import DeviceLoader
+from op_lib.augment import BatchHFlip
 from op_lib import dist_utils
 
 from models.get_model import get_model
 
 
+# dataset name -> backend -> dataset class
 torch_dataset_map = {
-    'temp_input_dataset': (DiskTempInputDataset, TempInputDataset),
-    'vel_dataset': (DiskTempVelDataset, TempVelDataset),
-    'vel_only_dataset' : (DiskVelInputDataset,VelInputDataset),
-    'vel_coord_dataset' : (DiskVelCoordInputDataset,VelCoordInputDataset),
-    'vel_dfun_dataset' : (DiskVelDfunDataset,VelDfunDataset)
+    'temp_input_dataset': {'disk': DiskTempInputDataset, 'memory': TempInputDataset, 'mmap': MmapTempInputDataset},
+    'vel_dataset': {'disk': DiskTempVelDataset, 'memory': TempVelDataset, 'mmap': MmapTempVelDataset},
+    'vel_only_dataset' : {'disk': DiskVelInputDataset, 'memory': VelInputDataset, 'mmap': MmapVelInputDataset},
+    'vel_coord_dataset' : {'disk': DiskVelCoordInputDataset, 'memory': VelCoordInputDataset, 'mmap': MmapVelCoordInputDataset},
+    'vel_dfun_dataset' : {'disk': DiskVelDfunDataset, 'memory': VelDfunDataset, 'mmap': MmapVelDfunDataset}
 }
 
 trainer_map = {
@@ -69,25 +83,65 @@ def build_datasets(cfg):
     use_coords = cfg.experiment.train.use_coords
     steady_time = cfg.dataset.steady_time
 
+    extra_kwargs = {}
+    if cfg.experiment.torch_dataset_name == 'vel_dfun_dataset':
+        # optional directory for the cached nucleation layer sidecar files
+        extra_kwargs['nucleation_cache_dir'] = cfg.dataset.get('nucleation_cache_dir', None)
+
+    # the train set is read from disk by default. The in-memory datasets
+    # can share one copy per node through shared memory, see shm_dir.
+    # mmap reads stores written by scripts/convert_mmap.py
+    backend = cfg.dataset.get('backend', 'disk')
+    backend_kwargs = {
+        # HDF5 chunk cache used by the disk-backed datasets
+        'disk': {
+            'rdcc_nbytes': cfg.dataset.get('rdcc_nbytes', None),
+            'rdcc_nslots': cfg.dataset.get('rdcc_nslots', None),
+            'stats_cache_dir': cfg.dataset.get('stats_cache_dir', None),
+        },
+        'memory': {
+            'shm_dir': cfg.dataset.get('shm_dir', None),
+            # float32, bfloat16 or float16. None keeps the dtype of the files
+            'storage_dtype': cfg.dataset.get('storage_dtype', None),
+            'stats_cache_dir': cfg.dataset.get('stats_cache_dir', None),
+        },
+        'mmap': {
+            'mmap_dir': cfg.dataset.get('mmap_dir', None),
+        },
+    }
+
+    # the train set is downsampled when it is read, so only the rows and
+    # columns the model sees are loaded and transferred.
+    downsample_kwargs = {
+        'downsample_factor': cfg.experiment.train.downsample_factor,
+        'pool': cfg.experiment.train.get('downsample_pool', 'stride'),
+    }
+
     # normalize temperatures and velocities to [-1, 1]
+    # the flips of cfg.dataset.transform are applied to whole batches, see build_dataloaders
     train_dataset = HDF5ConcatDataset([
-        DatasetClass[0](p,
+        DatasetClass[backend](p,
                         steady_time=cfg.dataset.steady_time,
                         use_coords=use_coords,
-                        transform=cfg.dataset.transform,
+                        transform=False,
                         time_window=time_window,
                         future_window=future_window,
-                        push_forward_steps=push_forward_steps) for p in cfg.dataset.train_paths])
+                        push_forward_steps=push_forward_steps,
+                        **backend_kwargs[backend],
+                        **downsample_kwargs,
+                        **extra_kwargs) for p in cfg.dataset.train_paths])
     train_max_temp = train_dataset.normalize_temp_()
     train_max_vel = train_dataset.normalize_vel_()
 
     # use same mapping as train dataset to normalize validation set
     val_dataset = HDF5ConcatDataset([
-        DatasetClass[1](p,
+        DatasetClass['memory'](p,
                         steady_time=cfg.dataset.steady_time,
                         use_coords=use_coords,
                         time_window=time_window,
-                        future_window=future_window) for p in cfg.dataset.val_paths])
+                        future_window=future_window,
+                        **backend_kwargs['memory'],
+                        **extra_kwargs) for p in cfg.dataset.val_paths])
     val_dataset.normalize_temp_(train_max_temp)
     val_dataset.normalize_vel_(train_max_vel)
 
@@ -103,15 +157,49 @@ def build_dataloaders(train_dataset, val_dataset, cfg):
                                          shuffle=False)
     else:
         train_sampler, val_sampler = None, None
+
+    # shuffle blocks of consecutive timesteps, so reads are mostly sequential within a file
+    if cfg.experiment.train.get('sampler', 'default') == 'block':
+        train_sampler = BlockShuffleSampler(train_dataset,
+                                            block_size=cfg.experiment.train.get('block_size', 32),
+                                            files_in_flight=cfg.experiment.train.get('files_in_flight', 2),
+                                            buffer_size=cfg.experiment.train.get('shuffle_buffer_size', 256),
+                                            shuffle=cfg.experiment.train.shuffle_data)
     
     train_shuffle = cfg.experiment.train.shuffle_data and (train_sampler is None)
-    train_dataloader = DataLoader(train_dataset, 
-                                  sampler=train_sampler,
-                                  shuffle=train_shuffle,
-                                  batch_size=cfg.experiment.train.batch_size,
-                                  num_workers=4,
-                                  pin_memory=True,
-                                  prefetch_factor=2)
+
+    # random hflip of a subset of each batch, after collation
+    augment, generator = None, None
+    if cfg.dataset.transform:
+        augment_seed = cfg.experiment.train.get('augment_seed', None)
+        augment = BatchHFlip(train_dataset.outputs(), seed=augment_seed)
+        if augment_seed is not None:
+            # seeds the workers, so their flips are reproducible
+            generator = torch.Generator()
+            generator.manual_seed(augment_seed)
+
+    if cfg.experiment.train.get('device_loader', False):
+        # the train set is kept on the device and batches are gathered there
+        assert cfg.dataset.get('backend', 'disk') == 'memory', 'device_loader needs the memory backend'
+        device = dist_utils.local_device()
+        for dataset in train_dataset.datasets:
+            dataset.to(device)
+        train_dataloader = DeviceLoader(train_dataset,
+                                        sampler=train_sampler,
+                                        shuffle=train_shuffle,
+                                        batch_size=cfg.experiment.train.batch_size,
+                                        augment=augment)
+    else:
+        train_dataloader = DataLoader(train_dataset, 
+                                      sampler=train_sampler,
+                                      shuffle=train_shuffle,
+                                      batch_size=cfg.experiment.train.batch_size,
+                                      num_workers=4,
+                                      worker_init_fn=worker_init_fn,
+                                      collate_fn=partial(collate, augment=augment),
+                                      generator=generator,
+                                      pin_memory=True,
+                                      prefetch_factor=2)
     # Iterate over the DataLoader
     #for i, batch in enumerate(train_dataloader):
         # Unpack the batch
@@ -128,6 +216,7 @@ def build_dataloaders(train_dataset, val_dataset, cfg):
                                 batch_size=cfg.experiment.train.batch_size,
                                 shuffle=False,
                                 num_workers=2,
+                                collate_fn=collate,
                                 pin_memory=True,
                                 prefetch_factor=2)
     return train_dataloader, val_dataloader
@@ -180,8 +269,9 @@ def train_app(cfg):
     
 
     # domain_rows and domain_cols are used to determine the number of modes
-    # used in fourier models.
-    _, domain_rows, domain_cols = train_dataset.datum_dim()
+    # used in fourier models. The train set is already downsampled, so use
+    # the full resolution of the val set.
+    _, domain_rows, domain_cols = val_dataset.datum_dim()
     downsampled_rows = domain_rows / downsample_factor[0]
     downsampled_cols = domain_cols / downsample_factor[1]
 
@@ -190,10 +280,11 @@ def train_app(cfg):
                       out_channels,
                       downsampled_rows,
                       downsampled_cols,
-                      exp)
+                      exp,
+                      device=dist_utils.local_device())
 
     if cfg.model_checkpoint:
-        model.load_state_dict(torch.load(cfg.model_checkpoint))
+        model.load_state_dict(torch.load(cfg.model_checkpoint, map_location=dist_utils.local_device()))
     print(model)
     np = nparams(model)
     print(f'Model has {np} parameters')
@@ -202,20 +293,22 @@ def train_app(cfg):
                                   lr=dist_utils.world_size() * exp.optimizer.initial_lr,
                                   weight_decay=exp.optimizer.weight_decay)
 
-    total_iters = exp.train.max_epochs * len(train_dataloader)
+    # the lr schedule steps with the optimizer, once per accumulation_steps batches
+    steps_per_epoch = math.ceil(len(train_dataloader) / exp.train.get('accumulation_steps', 1))
+    total_iters = exp.train.max_epochs * steps_per_epoch
     warmup_iters = max(1, int(math.sqrt(dist_utils.world_size()) * 0.03 * total_iters))
     warmup_lr = LinearWarmupLR(optimizer, warmup_iters)
     warm_iters = total_iters - warmup_iters
 
     if exp.lr_scheduler.name == 'step':
         warm_schedule = torch.optim.lr_scheduler.StepLR(optimizer,
-                                                        # scaled by len(dataloader) because we check each step
+                                                        # scaled by steps_per_epoch because we check each step
                                                         # so it's compatible with cosine scheduler
-                                                        step_size=exp.lr_scheduler.patience * len(train_dataloader),
+                                                        step_size=exp.lr_scheduler.patience * steps_per_epoch,
                                                         gamma=exp.lr_scheduler.factor)
     elif exp.lr_scheduler.name == 'cosine':
         warm_schedule = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer,
-                                                                   T_max=exp.train.max_epochs * len(train_dataloader),
+                                                                   T_max=exp.train.max_epochs * steps_per_epoch,
                                                                    eta_min=exp.lr_scheduler.eta_min)
     # SequentialLR produces a deprecation warning when calling sub-schedulers.
     # https://github.com/pytorch/pytorch/issues/76113
@@ -234,6 +327,10 @@ def train_app(cfg):
                            exp)
     print(trainer)
 
+    shard_test = cfg.experiment.get('shard_test', None)
+    if shard_test is None:
+        shard_test = cfg.experiment.distributed
+
     if cfg.train and not cfg.model_checkpoint:
         trainer.train(exp.train.max_epochs, log_dir, dataset_name=cfg.dataset.name)
         timestamp = int(time.time())
@@ -250,7 +347,10 @@ def train_app(cfg):
         ckpt_path = f'{ckpt_root}/{ckpt_file}'
         print(f'saving model to {ckpt_path}')
 
-        if cfg.test and dist_utils.is_leader_process():
+        metrics = None
+        if cfg.test and shard_test:
+            metrics = trainer.evaluate(val_dataset.datasets)
+        elif cfg.test and dist_utils.is_leader_process():
             metrics = trainer.test(val_dataset.datasets[0])
         
         save_dict = {
@@ -272,9 +372,29 @@ def train_app(cfg):
 
         torch.save(save_dict, f'{ckpt_path}')
 
-    if cfg.test and dist_utils.is_leader_process():
+    # metrics of rollouts of every val simulation, sharded over the ranks
+    if cfg.test and shard_test:
+        trainer.evaluate(val_dataset.datasets)
+    elif cfg.test and dist_utils.is_leader_process():
         metrics = trainer.test(val_dataset.datasets[0])
         print(metrics)
 
+    # stream long rollouts of the val simulations to hdf5 files
+    rollout_dir = cfg.get('rollout_dir', None)
+    if rollout_dir and dist_utils.is_leader_process():
+        datasets = val_dataset.datasets
+        future_window = exp.train.future_window
+        max_steps = min((len(dataset) - 1) // future_window + 1 for dataset in datasets)
+        num_steps = min(cfg.get('rollout_steps', None) or max_steps, max_steps)
+        Path(rollout_dir).mkdir(parents=True, exist_ok=True)
+        paths = [f'{rollout_dir}/{Path(dataset.filename).name}' for dataset in datasets]
+        trainer.write_rollout(datasets,
+                              paths,
+                              num_steps,
+                              labels=cfg.get('rollout_labels', False),
+                              metrics=cfg.get('rollout_metrics', False),
+                              compression=cfg.get('rollout_compression', None))
+        print(f'wrote {num_steps} rollout steps to {rollout_dir}')
+
 if __name__ == '__main__':
     train_app()
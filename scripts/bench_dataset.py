@@ -0,0 +1,94 @@
+r"""
+Microbenchmark for the sciml datasets.
+Times __getitem__ and counts how many of the returned tensors are newly
+allocated, rather than views of the tensors held by the dataset.
+
+python scripts/bench_dataset.py --path Twall-100.hdf5 --dataset vel_dataset
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+import torch
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'sciml'))
+
+from op_lib import disk_hdf5_dataset, hdf5_dataset, mmap_dataset
+from op_lib.hdf5_dataset import HDF5ConcatDataset
+
+# same dataset names as sciml/train.py
+dataset_class_names = {
+    'temp_input_dataset': 'TempInputDataset',
+    'vel_dataset': 'TempVelDataset',
+    'vel_only_dataset': 'VelInputDataset',
+    'vel_coord_dataset': 'VelCoordInputDataset',
+    'vel_dfun_dataset': 'VelDfunDataset',
+}
+backends = {
+    'disk': lambda name: getattr(disk_hdf5_dataset, f'Disk{name}'),
+    'memory': lambda name: getattr(hdf5_dataset, name),
+    'mmap': lambda name: getattr(mmap_dataset, f'Mmap{name}'),
+}
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--path', type=str, nargs='+', help='path(s) to hdf5 simulation files')
+parser.add_argument('--dataset', type=str, default='vel_dataset', choices=list(dataset_class_names.keys()))
+parser.add_argument('--backend', type=str, default='memory', choices=list(backends.keys()))
+parser.add_argument('--steady_time', type=int, default=30)
+parser.add_argument('--time_window', type=int, default=5)
+parser.add_argument('--future_window', type=int, default=5)
+parser.add_argument('--push_forward_steps', type=int, default=1)
+parser.add_argument('--iters', type=int, default=200)
+parser.add_argument('--shm_dir', type=str, default=None, help='shared memory directory for the memory backend')
+parser.add_argument('--storage_dtype', type=str, default=None, help='storage dtype for the memory backend')
+parser.add_argument('--mmap_dir', type=str, default=None, help='directory of the stores for the mmap backend')
+args = parser.parse_args()
+
+def storages(dataset):
+    r"""
+    Storage of every tensor held by the dataset.
+    """
+    tensors = [t for t in vars(dataset).values() if torch.is_tensor(t)]
+    data = getattr(dataset, '_data', {})
+    if isinstance(data, dict):
+        tensors += [t for t in data.values() if torch.is_tensor(t)]
+    return {t.untyped_storage().data_ptr() for t in tensors}
+
+def main():
+    DatasetClass = backends[args.backend](dataset_class_names[args.dataset])
+    kwargs = {
+        'disk': {},
+        'memory': {'shm_dir': args.shm_dir, 'storage_dtype': args.storage_dtype},
+        'mmap': {'mmap_dir': args.mmap_dir},
+    }[args.backend]
+    start = time.time()
+    dataset = HDF5ConcatDataset([
+        DatasetClass(p,
+                     steady_time=args.steady_time,
+                     use_coords=True,
+                     time_window=args.time_window,
+                     future_window=args.future_window,
+                     push_forward_steps=args.push_forward_steps,
+                     **kwargs) for p in args.path])
+    dataset.normalize_temp_()
+    dataset.normalize_vel_()
+    print(f'load time {time.time() - start:.3f} (s)')
+
+    shared = set()
+    for d in dataset.datasets:
+        shared |= storages(d)
+
+    iters = min(args.iters, len(dataset))
+    allocs = 0
+    start = time.time()
+    for idx in range(iters):
+        item = dataset[idx]
+        allocs += sum(t.untyped_storage().data_ptr() not in shared for t in item)
+    dur = time.time() - start
+
+    print(f'{args.backend} {args.dataset}: {iters / dur:.1f} samples/s')
+    print(f'{allocs / iters:.2f} allocated tensors per sample ({len(item)} outputs)')
+
+if __name__ == '__main__':
+    main()
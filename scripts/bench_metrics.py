@@ -0,0 +1,77 @@
+r"""
+Microbenchmark for the rollout metrics of sciml/op_lib/metrics.py.
+Times fourier_error and interface_rmse on random [T x H x W] frames at
+several resolutions, and checks fourier_error against the reference loop
+over the modes.
+
+python scripts/bench_metrics.py --frames 100 --res 64 128 256 512
+"""
+
+import argparse
+import math
+import sys
+import time
+from pathlib import Path
+import torch
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'sciml'))
+
+from op_lib import metrics
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--frames', type=int, default=100)
+parser.add_argument('--res', type=int, nargs='+', default=[64, 128, 256, 512])
+parser.add_argument('--device', type=str, default='cpu')
+parser.add_argument('--iters', type=int, default=5)
+parser.add_argument('--no_reference', action='store_true', help='skip the (slow) reference loops')
+args = parser.parse_args()
+
+def fourier_error_loop(pred, target, Lx, Ly):
+    r"""
+    The loop over the modes that fourier_error replaces.
+    """
+    ILOW = 4
+    IHIGH = 12
+    pred_F = torch.fft.fftn(pred, dim=[1, 2])
+    target_F = torch.fft.fftn(target, dim=[1, 2])
+    nb, nx, ny = target.size()
+    _err_F = torch.abs(pred_F - target_F) ** 2
+    err_F = torch.zeros((nb, min(nx // 2, ny // 2)), device=pred.device)
+    for i in range(nx // 2):
+        for j in range(ny // 2):
+            it = math.floor(math.sqrt(i ** 2 + j ** 2))
+            if it > min(nx // 2, ny // 2) - 1:
+                continue
+            err_F[:, it] += _err_F[:, i, j]
+    _err_F = torch.sqrt(torch.mean(err_F, axis=0)) / (nx * ny) * Lx * Ly
+    return torch.mean(_err_F[:ILOW]), torch.mean(_err_F[ILOW:IHIGH]), torch.mean(_err_F[IHIGH:])
+
+def bench(fn, *fn_args):
+    fn(*fn_args)
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(args.iters):
+        out = fn(*fn_args)
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return (time.time() - start) / args.iters, out
+
+def main():
+    torch.manual_seed(0)
+    for res in args.res:
+        label = torch.rand(args.frames, res, res, device=args.device)
+        pred = label + 0.1 * torch.randn_like(label)
+        dur, out = bench(metrics.fourier_error, pred, label, 8, 8)
+        line = f'fourier_error {args.frames}x{res}x{res}: {1000 * dur:.2f} (ms)'
+        if not args.no_reference:
+            ref_dur, ref = bench(fourier_error_loop, pred, label, 8, 8)
+            rel = max(((a - b).abs() / b.abs()).item() for a, b in zip(out, ref))
+            line += f', loop {1000 * ref_dur:.2f} (ms), max relative difference {rel:.2e}'
+        print(line)
+        dfun = torch.randn_like(label)
+        dur, _ = bench(metrics.interface_rmse, pred, label, dfun)
+        print(f'interface_rmse {args.frames}x{res}x{res}: {1000 * dur:.2f} (ms)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+r"""
+Convert HDF5 simulations to a memory-mappable tensor store.
+Each Twall-*.hdf5 becomes a directory <stem>.mmap containing one
+little-endian .npy file per field and a manifest.json. The files are
+uncompressed, so a window of frames is read straight from the page cache.
+
+    temperature.npy [T x H x W]      temperature, as stored in the hdf5 file
+    vel.npy         [T x 2 x H x W]  velx and vely interleaved
+    dfun.npy        [T x H x W]      sign of dfun (int8)
+    x.npy, y.npy    [H x W]          the grid, which is static
+
+NaNs are replaced with zeros. The manifest has the shape and dtype of each
+field, per-frame statistics (so they can be reduced for any steady_time)
+and the runtime parameters of the simulation.
+
+python scripts/convert_mmap.py --src <dir with hdf5 files> --dst <dir>
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import h5py
+import numpy as np
+from pathlib import Path
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--src', type=str, help='directory of hdf5 files to convert')
+parser.add_argument('--dst', type=str, default=None, help='directory to write the stores. Defaults to src')
+parser.add_argument('--chunk_frames', type=int, default=64, help='number of frames converted at once')
+parser.add_argument('--overwrite', action='store_true', help='replace existing stores')
+args = parser.parse_args()
+
+MANIFEST_VERSION = 1
+
+def little_endian(dtype):
+    return np.dtype(dtype).newbyteorder('<')
+
+def frame_stats(frames):
+    r"""
+    min, max, mean and std of each frame in a chunk [n x ...]
+    """
+    flat = frames.reshape(frames.shape[0], -1).astype(np.float64)
+    return {
+        'min': flat.min(axis=1).tolist(),
+        'max': flat.max(axis=1).tolist(),
+        'mean': flat.mean(axis=1).tolist(),
+        'std': flat.std(axis=1).tolist(),
+    }
+
+def runtime_params(dset):
+    r"""
+    Runtime params are stored as (name, value) pairs.
+    """
+    params = {}
+    for name, value in dset[:].reshape(-1, 2) if dset.dtype.names is None else dset[:]:
+        name = name.decode().strip() if isinstance(name, bytes) else str(name).strip()
+        value = value.decode().strip() if isinstance(value, bytes) else value.item()
+        params[name] = value
+    return params
+
+def write_field(dst_dir, name, shape, dtype, chunks):
+    r"""
+    Write the chunks of a field to <name>.npy and return its manifest entry.
+    """
+    dtype = little_endian(dtype)
+    array = np.lib.format.open_memmap(dst_dir / f'{name}.npy', mode='w+', dtype=dtype, shape=shape)
+    stats = {'min': [], 'max': [], 'mean': [], 'std': []}
+    start = 0
+    for chunk in chunks:
+        array[start:start + chunk.shape[0]] = chunk
+        for key, values in frame_stats(chunk).items():
+            stats[key] += values
+        start += chunk.shape[0]
+    array.flush()
+    del array
+    return {
+        'file': f'{name}.npy',
+        'shape': list(shape),
+        'dtype': dtype.str,
+        'stats': stats,
+    }
+
+def convert(src_file, dst_file):
+    tmp_dir = dst_file.with_suffix('.mmap.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    n = args.chunk_frames
+
+    with h5py.File(src_file, 'r') as f:
+        num_frames, rows, cols = f['temperature'].shape
+        fields = {}
+
+        def read(key, start):
+            return np.nan_to_num(f[key][start:start + n])
+
+        fields['temperature'] = write_field(
+            tmp_dir, 'temperature', (num_frames, rows, cols), f['temperature'].dtype,
+            (read('temperature', s) for s in range(0, num_frames, n)))
+        fields['vel'] = write_field(
+            tmp_dir, 'vel', (num_frames, 2, rows, cols), f['velx'].dtype,
+            (np.stack([read('velx', s), read('vely', s)], axis=1) for s in range(0, num_frames, n)))
+        fields['vel']['components'] = ['velx', 'vely']
+        fields['dfun'] = write_field(
+            tmp_dir, 'dfun', (num_frames, rows, cols), np.int8,
+            (np.sign(read('dfun', s)).astype(np.int8) for s in range(0, num_frames, n)))
+        fields['dfun']['encoding'] = 'sign'
+        for key in ('x', 'y'):
+            grid = f[key][0].astype(little_endian(f[key].dtype))
+            np.save(tmp_dir / f'{key}.npy', grid)
+            fields[key] = {'file': f'{key}.npy', 'shape': list(grid.shape), 'dtype': grid.dtype.str}
+
+        params = {}
+        for key in ('real-runtime-params', 'int-runtime-params'):
+            if key in f:
+                params[key] = runtime_params(f[key])
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'source': src_file.name,
+        'source_mtime': os.path.getmtime(src_file),
+        'shape': [num_frames, rows, cols],
+        'fields': fields,
+        'runtime_params': params,
+    }
+    with open(tmp_dir / 'manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    if dst_file.exists():
+        shutil.rmtree(dst_file)
+    os.replace(tmp_dir, dst_file)
+
+dst_dir = Path(args.dst if args.dst else args.src)
+dst_dir.mkdir(parents=True, exist_ok=True)
+src_files = sorted(Path(fn) for fn in glob.glob(f'{args.src}/*.hdf5'))
+print(src_files)
+
+for src_file in src_files:
+    dst_file = dst_dir / f'{src_file.stem}.mmap'
+    if dst_file.exists() and not args.overwrite:
+        print(f'{dst_file} exists, skipping')
+        continue
+    print(f'converting {src_file} to {dst_file}')
+    convert(src_file, dst_file)
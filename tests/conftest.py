@@ -0,0 +1,34 @@
+import sys
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'sciml'))
+
+def write_simulation(path, seed, num_frames=40, rows=32, cols=40):
+    r"""
+    A small random simulation with the layout of the BubbleML hdf5 files.
+    """
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.linspace(-5, 5, cols), np.linspace(0.1, 6, rows))
+    with h5py.File(path, 'w') as f:
+        f['temperature'] = rng.random((num_frames, rows, cols))
+        f['velx'] = 0.1 * rng.standard_normal((num_frames, rows, cols))
+        f['vely'] = 0.1 * rng.standard_normal((num_frames, rows, cols))
+        f['dfun'] = rng.standard_normal((num_frames, rows, cols))
+        f['pressure'] = rng.random((num_frames, rows, cols))
+        f['x'] = np.broadcast_to(x, (num_frames, rows, cols))
+        f['y'] = np.broadcast_to(y, (num_frames, rows, cols))
+        f['real-runtime-params'] = np.array([[b'a', b'1.0']])
+        f['int-runtime-params'] = np.array([[b'b', b'2']])
+    return path
+
+@pytest.fixture(scope='session')
+def simulations(tmp_path_factory):
+    r"""
+    Paths of three small simulations with different wall temperatures.
+    """
+    root = tmp_path_factory.mktemp('simulations')
+    return [str(write_simulation(root / f'Twall-{wall}.hdf5', seed)) for seed, wall in enumerate((90, 95, 100))]
@@ -0,0 +1,90 @@
+import dataclasses
+import os
+import socket
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from omegaconf import OmegaConf
+from torch import nn
+
+from op_lib import hdf5_dataset, push_vel_trainer
+from op_lib.push_vel_trainer import PushVelTrainer
+
+# test() calls them temp, evaluate uses the keys of the simulation file
+TEST_KEYS = {'temp': 'temperature', 'velx': 'velx', 'vely': 'vely'}
+
+def build_trainer(paths):
+    datasets = [hdf5_dataset.TempVelDataset(path, steady_time=4, use_coords=True, time_window=3, future_window=3)
+                for path in paths]
+    val_dataset = hdf5_dataset.HDF5ConcatDataset(datasets)
+    val_dataset.normalize_temp_()
+    val_dataset.normalize_vel_()
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Conv2d(datasets[0].in_channels, 8, 3, padding=1),
+                          nn.Tanh(),
+                          nn.Conv2d(8, datasets[0].out_channels, 3, padding=1))
+    cfg = OmegaConf.create({
+        'train': {'use_coords': True, 'noise': False, 'max_epochs': 1},
+        'distributed': False,
+        'torch_dataset_name': 'push_vel',
+    })
+    trainer = PushVelTrainer(model, 3, 1, None, None, None, None, 0, None, cfg)
+    return trainer, datasets
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def run_evaluate(rank, world_size, port, paths, out):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        trainer, datasets = build_trainer(paths)
+        results = trainer.evaluate(datasets, max_time_limit=100)
+        if rank == 0:
+            torch.save(results, out)
+        else:
+            assert results is None
+    finally:
+        dist.destroy_process_group()
+
+@pytest.fixture(scope='module')
+def monkeypatch_module():
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        yield monkeypatch
+
+
+@pytest.fixture(scope='module')
+def leader_results(simulations, monkeypatch_module):
+    r"""
+    The metrics of PushVelTrainer.test on every simulation, in one process.
+    """
+    results = []
+    compute_field_metrics = push_vel_trainer.compute_field_metrics
+    def record(*args):
+        results.append(compute_field_metrics(*args))
+        return results[-1]
+    monkeypatch_module.setattr(push_vel_trainer, 'compute_field_metrics', record)
+    for name in ('plt_iter_mae', 'plt_temp', 'plt_vel'):
+        monkeypatch_module.setattr(push_vel_trainer, name, lambda *args: None)
+    trainer, datasets = build_trainer(simulations)
+    for dataset in datasets:
+        trainer.test(dataset, max_time_limit=100)
+    return [{TEST_KEYS[key]: value for key, value in metrics.items()} for metrics in results]
+
+# 3 simulations do not divide evenly over 2 ranks, and 4 ranks leave one idle
+@pytest.mark.parametrize('world_size', [2, 4])
+def test_sharded_evaluate_matches_test(simulations, leader_results, world_size, tmp_path):
+    out = tmp_path / 'results.pt'
+    mp.spawn(run_evaluate, args=(world_size, free_port(), simulations, str(out)), nprocs=world_size)
+    results = torch.load(out, weights_only=False)
+    assert len(results) == len(leader_results)
+    for sharded, expected in zip(results, leader_results):
+        assert sharded.keys() == expected.keys()
+        for key in expected:
+            for field in dataclasses.fields(expected[key]):
+                value = float(getattr(sharded[key], field.name))
+                assert value == pytest.approx(float(getattr(expected[key], field.name)), rel=1e-5, abs=1e-7), (key, field.name)
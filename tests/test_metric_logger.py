@@ -0,0 +1,88 @@
+import threading
+
+import pytest
+import torch
+
+from op_lib.metric_logger import AsyncScalarWriter, MetricAccumulator
+from op_lib.metrics import write_metrics
+
+class RecordingWriter:
+    r"""
+    Records add_scalar calls like a tensorboard SummaryWriter.
+    """
+    def __init__(self, fail_at=()):
+        self.scalars = {}
+        self.fail_at = set(fail_at)
+
+    def add_scalar(self, tag, value, global_step):
+        if global_step in self.fail_at:
+            self.fail_at.remove(global_step)
+            raise RuntimeError('write failed')
+        self.scalars[(tag, global_step)] = float(value)
+
+    def flush(self):
+        pass
+
+def batches(num_iters, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    for _ in range(num_iters):
+        pred = torch.rand(4, 8, 8, generator=generator)
+        label = torch.rand(4, 8, 8, generator=generator)
+        yield torch.nn.functional.mse_loss(pred, label), pred, label
+
+def flush_within(writer, timeout=10):
+    thread = threading.Thread(target=writer.flush, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return not thread.is_alive()
+
+def test_matches_write_metrics():
+    # the scalars the train loop wrote before, iteration by iteration
+    expected = RecordingWriter()
+    for global_iter, (loss, pred, label) in enumerate(batches(5)):
+        expected.add_scalar('Loss/train', loss, global_iter)
+        write_metrics(pred, label, global_iter, 'TrainVel', expected)
+
+    writer = RecordingWriter()
+    scalar_writer = AsyncScalarWriter(writer)
+    log = MetricAccumulator(scalar_writer, 'train')
+    for global_iter, (loss, pred, label) in enumerate(batches(5)):
+        log.update(loss, {'TrainVel': (pred, label)}, global_iter)
+    log.flush()
+    scalar_writer.flush()
+
+    assert writer.scalars.keys() == expected.scalars.keys()
+    for key, value in expected.scalars.items():
+        assert writer.scalars[key] == pytest.approx(value, rel=1e-6), key
+
+def test_interval():
+    writer = RecordingWriter()
+    scalar_writer = AsyncScalarWriter(writer)
+    log = MetricAccumulator(scalar_writer, 'train', interval=3)
+    data = list(batches(4))
+    for global_iter, (loss, pred, label) in enumerate(data):
+        log.update(loss, {'TrainVel': (pred, label)}, global_iter)
+    log.flush()
+    scalar_writer.flush()
+
+    # means (and the max of MaxERror) of iterations 0-2, written at 2, then iteration 3
+    assert {step for _, step in writer.scalars} == {2, 3}
+    losses = torch.stack([loss for loss, _, _ in data[:3]]).double()
+    max_errors = torch.stack([((pred - label) ** 2).max() for _, pred, label in data[:3]]).double()
+    assert writer.scalars[('Loss/train', 2)] == pytest.approx(losses.mean().item())
+    assert writer.scalars[('TrainVel/MaxERror', 2)] == pytest.approx(max_errors.max().item())
+    assert writer.scalars[('Loss/train', 3)] == pytest.approx(data[3][0].item())
+
+def test_failed_write_does_not_stop_the_writer():
+    writer = RecordingWriter(fail_at=[1])
+    scalar_writer = AsyncScalarWriter(writer)
+    for global_step in range(3):
+        scalar_writer.add_scalars(['Loss/train'], torch.tensor([float(global_step)]), global_step)
+    assert flush_within(scalar_writer)
+    # the failed step is dropped, the later ones are still written
+    assert writer.scalars == {('Loss/train', 0): 0.0, ('Loss/train', 2): 2.0}
+
+def test_without_writer():
+    scalar_writer = AsyncScalarWriter(None)
+    scalar_writer.add_scalars(['Loss/train'], torch.tensor([1.0]), 0)
+    assert flush_within(scalar_writer)
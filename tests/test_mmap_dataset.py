@@ -0,0 +1,46 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+
+from op_lib import disk_hdf5_dataset, hdf5_dataset, mmap_dataset
+
+CONVERT = Path(__file__).resolve().parents[1] / 'scripts' / 'convert_mmap.py'
+DATASETS = ('TempInputDataset', 'TempVelDataset', 'VelInputDataset', 'VelCoordInputDataset', 'VelDfunDataset')
+
+@pytest.fixture(scope='module')
+def mmap_dir(simulations, tmp_path_factory):
+    dst = tmp_path_factory.mktemp('mmap')
+    src = Path(simulations[0]).parent
+    subprocess.run([sys.executable, str(CONVERT), '--src', str(src), '--dst', str(dst)], check=True)
+    return dst
+
+def build(module, name, path, cache_dir, **kwargs):
+    r"""
+    The dataset and its scales, read before it is normalized.
+    """
+    extra = {'nucleation_cache_dir': str(cache_dir)} if 'VelDfun' in name else {}
+    dataset = getattr(module, name)(path, steady_time=4, use_coords=True, time_window=3, future_window=3,
+                                    push_forward_steps=2 if 'TempVel' in name else 1, **extra, **kwargs)
+    scales = (float(dataset.absmax_temp()), float(dataset.absmax_vel()))
+    dataset.normalize_temp_(110.)
+    dataset.normalize_vel_(0.5)
+    return dataset, scales
+
+@pytest.mark.parametrize('downsample_factor', [1, [2, 3]])
+@pytest.mark.parametrize('name', DATASETS)
+def test_mmap_matches_hdf5(simulations, mmap_dir, tmp_path, name, downsample_factor):
+    path = simulations[-1]
+    mmap, mmap_scales = build(mmap_dataset, 'Mmap' + name, path, tmp_path, mmap_dir=str(mmap_dir), downsample_factor=downsample_factor)
+    backends = [build(disk_hdf5_dataset, 'Disk' + name, path, tmp_path, downsample_factor=downsample_factor),
+                build(hdf5_dataset, name, path, tmp_path, downsample_factor=downsample_factor)]
+    for dataset, scales in backends:
+        assert len(mmap) == len(dataset)
+        assert mmap_scales == pytest.approx(scales)
+        for timestep in (0, len(mmap) // 2, len(mmap) - 1):
+            assert len(mmap[timestep]) == len(dataset[timestep])
+            for expected, actual in zip(dataset[timestep], mmap[timestep]):
+                assert actual.shape == expected.shape
+                assert torch.allclose(actual.double(), expected.double(), atol=1e-6), (name, timestep)